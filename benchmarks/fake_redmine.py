@@ -0,0 +1,224 @@
+'''A local stand-in for the parts of the Redmine REST API used by ical2redmine,
+serving the users iCal feeds as well.'''
+import BaseHTTPServer, SocketServer, threading, time, urlparse, re
+from datetime import datetime
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+TIME_ENTRY_FIELD_ID = 1
+USER_FIELD_ID = 2
+
+# Redmine never returns more than this many resources in a page.
+MAX_LIMIT = 100
+
+ENTRY_PATH_PATTERN = re.compile(r'^/time_entries/(\d+)\.xml$')
+FEED_PATH_PATTERN = re.compile(r'^/feeds/(\w+)\.ics$')
+
+class FakeRedmine(object):
+	'''Keeps users, time entries and feeds in memory, serving them over HTTP on
+	a free local port. Every request is delayed by latency seconds, and counted
+	by its method.'''
+	def __init__(self, latency=0.0):
+		self.latency = latency
+		self.lock = threading.Lock()
+		self.users = []
+		self.entries = {}
+		self.feeds = {}
+		self.next_entry_id = 1
+		self.counts = {}
+		self.server = None
+
+	@property
+	def url(self):
+		'''The URL of the fake Redmine.'''
+		return "http://localhost:%u" % self.server.server_address[1]
+
+	def start(self):
+		'''Starts serving requests in a thread of its own.'''
+		self.server = FakeServer(('localhost', 0), FakeHandler)
+		self.server.redmine = self
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def stop(self):
+		'''Stops serving requests.'''
+		self.server.shutdown()
+		self.server.server_close()
+
+	def count(self, method):
+		'''Counts a request.'''
+		with self.lock:
+			self.counts[method] = self.counts.get(method, 0) + 1
+
+	def reset_counts(self):
+		'''Gets the counts of requests, and resets them.'''
+		with self.lock:
+			counts = self.counts
+			self.counts = {}
+			return counts
+
+	def add_user(self, login, feed):
+		'''Adds an active user with an iCal feed.'''
+		user = {
+			'id': len(self.users) + 1,
+			'login': login,
+			'mail': "%s@example.com" % login
+		}
+		self.users.append(user)
+		self.feeds[login] = feed
+		return user
+
+	def add_entry(self, user_id, values):
+		'''Adds a time entry of a user, returning it.'''
+		with self.lock:
+			entry = dict(values)
+			entry['id'] = self.next_entry_id
+			entry['user_id'] = user_id
+			entry['updated_on'] = datetime.utcnow().strftime("%Y-%m-%d")
+			self.entries[entry['id']] = entry
+			self.next_entry_id += 1
+			return entry
+
+	def find_user(self, login):
+		'''Finds a user by login, None if unknown.'''
+		for user in self.users:
+			if user['login'] == login:
+				return user
+		return None
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	'''Serves every request in a thread of its own, like a real Redmine would
+	serve requests in parallel.'''
+	daemon_threads = True
+
+def page(resources, query):
+	'''Gets the page of resources asked for, and the total count.'''
+	offset = int(query.get('offset', 0))
+	limit = min(int(query.get('limit', 25)), MAX_LIMIT)
+	return resources[offset:offset+limit], len(resources)
+
+def user2xml(user, feed_url):
+	'''Serializes a user, the way Redmine does.'''
+	return ("<user><id>%u</id><login>%s</login><mail>%s</mail>"
+		"<custom_fields type=\"array\"><custom_field id=\"%u\" "
+		"name=\"iCal Time Entry URL\"><value>%s</value></custom_field>"
+		"</custom_fields></user>") % (user['id'], escape(user['login']),
+		escape(user['mail']), USER_FIELD_ID, escape(feed_url))
+
+def entry2xml(entry):
+	'''Serializes a time entry, the way Redmine does.'''
+	return ("<time_entry><id>%u</id><project id=\"1\" name=\"Project\"/>"
+		"<issue id=%s/><user id=\"%u\"/><hours>%s</hours><comments>%s</comments>"
+		"<spent_on>%s</spent_on><custom_fields type=\"array\">"
+		"<custom_field id=\"%u\" name=\"iCal UID\"><value>%s</value>"
+		"</custom_field></custom_fields></time_entry>") % (entry['id'],
+		quoteattr(unicode(entry['issue_id'])), entry['user_id'],
+		escape(entry['hours']), escape(entry['comments'] or ''),
+		escape(entry['spent_on']), TIME_ENTRY_FIELD_ID, escape(entry['uid']))
+
+def xml2values(body):
+	'''Deserializes the values of a posted or put time entry.'''
+	element = ElementTree.fromstring(body)
+	values = {}
+	for field in ['issue_id', 'spent_on', 'hours', 'comments']:
+		values[field] = element.findtext(field)
+	values['uid'] = element.findtext('custom_fields/custom_field/value')
+	return values
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	'''Handles the requests to the fake Redmine.'''
+	protocol_version = 'HTTP/1.1'
+	# Buffers the responses, sending them at once, so only latency delays them.
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		'''Requests are counted, not logged.'''
+		pass
+
+	def respond(self, code, body='', content_type='application/xml'):
+		'''Sends a response, after the latency of the fake Redmine.'''
+		redmine = self.server.redmine
+		redmine.count(self.command)
+		if redmine.latency:
+			time.sleep(redmine.latency)
+		if isinstance(body, unicode):
+			body = body.encode('utf-8')
+		self.send_response(code)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def read_body(self):
+		'''Reads the body of the request.'''
+		return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+	def switched_user(self):
+		'''The user impersonated by the request.'''
+		return self.server.redmine.find_user(
+			self.headers.get('X-Redmine-Switch-User'))
+
+	def do_GET(self):
+		'''Lists custom fields, users and time entries, or serves a feed.'''
+		redmine = self.server.redmine
+		url = urlparse.urlparse(self.path)
+		query = dict(urlparse.parse_qsl(url.query))
+		feed_match = FEED_PATH_PATTERN.match(url.path)
+		if feed_match and feed_match.group(1) in redmine.feeds:
+			return self.respond(200, redmine.feeds[feed_match.group(1)],
+				'text/calendar')
+		elif url.path == '/custom_fields.xml':
+			return self.respond(200, "<custom_fields type=\"array\">"
+				"<custom_field><id>%u</id><name>iCal UID</name></custom_field>"
+				"<custom_field><id>%u</id><name>iCal Time Entry URL</name>"
+				"</custom_field></custom_fields>" % (TIME_ENTRY_FIELD_ID,
+				USER_FIELD_ID))
+		elif url.path == '/users.xml':
+			found_users, total_count = page(redmine.users, query)
+			return self.respond(200, "<users type=\"array\" total_count=\"%u\">"
+				"%s</users>" % (total_count, "".join([user2xml(user,
+				"%s/feeds/%s.ics" % (redmine.url, user['login']))
+				for user in found_users])))
+		elif url.path == '/time_entries.xml':
+			with redmine.lock:
+				found_entries = [entry for entry_id, entry
+					in sorted(redmine.entries.items())
+					if 'user_id' not in query or
+						unicode(entry['user_id']) == query['user_id']]
+			found_entries, total_count = page(found_entries, query)
+			return self.respond(200, "<time_entries type=\"array\" "
+				"total_count=\"%u\">%s</time_entries>" % (total_count,
+				"".join([entry2xml(entry) for entry in found_entries])))
+		self.respond(404)
+
+	def do_POST(self):
+		'''Creates a time entry, as the impersonated user.'''
+		redmine = self.server.redmine
+		if self.path.split('?')[0] != '/time_entries.xml':
+			return self.respond(404)
+		values = xml2values(self.read_body())
+		entry = redmine.add_entry(self.switched_user()['id'], values)
+		self.respond(201, entry2xml(entry))
+
+	def do_PUT(self):
+		'''Updates a time entry.'''
+		redmine = self.server.redmine
+		match = ENTRY_PATH_PATTERN.match(self.path.split('?')[0])
+		values = xml2values(self.read_body())
+		if values['uid'] is None:
+			del values['uid']
+		with redmine.lock:
+			entry = match and redmine.entries.get(int(match.group(1)))
+			if entry:
+				entry.update(values)
+		self.respond(200 if entry else 404)
+
+	def do_DELETE(self):
+		'''Deletes a time entry.'''
+		redmine = self.server.redmine
+		match = ENTRY_PATH_PATTERN.match(self.path.split('?')[0])
+		with redmine.lock:
+			entry = match and redmine.entries.pop(int(match.group(1)), None)
+		self.respond(200 if entry else 404)
@@ -0,0 +1,49 @@
+'''Generates synthetic iCal feeds, of past events referencing issues.'''
+import random
+from datetime import datetime, timedelta
+
+PATTERN = r'.*\[#(?P<issue_id>\d+)\]'
+
+def format_datetime(value):
+	'''Formats a datetime in UTC, the iCal way.'''
+	return value.strftime("%Y%m%dT%H%M%SZ")
+
+def generate(login, events, recurring=0.0, unmatched=0.0, seed=None):
+	'''Generates a feed of a user, with the given number of events ending
+	before now. A fraction of them recurs weekly, and a fraction doesn't
+	reference any issue.'''
+	randomizer = random.Random(seed)
+	now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+	lines = [
+		"BEGIN:VCALENDAR",
+		"VERSION:2.0",
+		"PRODID:-//ical2redmine//benchmarks//EN",
+		"X-WR-CALNAME:%s" % login
+	]
+	for number in range(events):
+		start = now - timedelta(hours=2 * (events - number) + 1)
+		end = start + timedelta(minutes=randomizer.choice([30, 60, 90, 120]))
+		if randomizer.random() < unmatched:
+			summary = "Lunch %u" % number
+		else:
+			summary = "Event %u [#%u]" % (number, randomizer.randint(1, 500))
+		recurs = randomizer.random() < recurring
+		if recurs:
+			# Recurring events starts weeks back, to have past occurrences.
+			start -= timedelta(weeks=4)
+			end -= timedelta(weeks=4)
+		lines.extend([
+			"BEGIN:VEVENT",
+			"UID:%s-%u@benchmarks" % (login, number),
+			"DTSTAMP:%s" % format_datetime(now),
+			"SEQUENCE:0",
+			"DTSTART:%s" % format_datetime(start),
+			"DTEND:%s" % format_datetime(end),
+			"SUMMARY:%s" % summary,
+			"DESCRIPTION:Worked on %s for %s" % (summary, login)
+		])
+		if recurs:
+			lines.append("RRULE:FREQ=WEEKLY;COUNT=4")
+		lines.append("END:VEVENT")
+	lines.append("END:VCALENDAR")
+	return "\r\n".join(lines) + "\r\n"
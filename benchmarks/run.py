@@ -0,0 +1,208 @@
+'''Benchmarks the stages of a sync, against a local fake Redmine server and
+synthetic iCal feeds. Run it with: python benchmarks/run.py --help'''
+import argparse, logging, os, random, resource, sys, time
+BENCHMARKS_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(BENCHMARKS_PATH, '..'))
+from ical2redmine.logger import LOG as log
+from ical2redmine.__main__ import DEFAULT_SETTINGS, LOG_LEVELS
+from ical2redmine import redmine, transport, users, entries, events, pool
+from ical2redmine import router
+from fake_redmine import FakeRedmine, TIME_ENTRY_FIELD_ID, USER_FIELD_ID
+import feeds
+
+def parse_arguments():
+	'''Parsing the runtime arguments given to the benchmark'''
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-u', '--users', type=int, default=10,
+		help='The number of users.')
+	parser.add_argument('-e', '--events', type=int, default=100,
+		help='The number of events in the feed of every user.')
+	parser.add_argument('--recurring', type=float, default=0.05,
+		help='The fraction of events that recurs weekly.')
+	parser.add_argument('--unmatched', type=float, default=0.1,
+		help="The fraction of events that doesn't reference an issue.")
+	parser.add_argument('--synced', type=float, default=0.5,
+		help='The fraction of events that already has an entry in Redmine.')
+	parser.add_argument('--changed', type=float, default=0.1,
+		help='The fraction of the synced events, that has changed since.')
+	parser.add_argument('--removed', type=float, default=0.05,
+		help='The number of entries of events removed from the feeds, as a '
+		'fraction of the events.')
+	parser.add_argument('--latency', type=float, default=0.005,
+		help='The seconds every request to the fake Redmine takes.')
+	parser.add_argument('-w', '--workers', type=int, default=1,
+		help='The number of users to process concurrently.')
+	parser.add_argument('--seed', type=int, default=0,
+		help='The seed of the random feeds and entries.')
+	parser.add_argument('-l', '--log', default='warning',
+		help='Set the log level.', choices=LOG_LEVELS)
+	return parser.parse_args()
+
+def make_settings(redmine_url, workers):
+	'''Makes the settings, as if loaded from a settings file.'''
+	settings = dict()
+	settings.update(DEFAULT_SETTINGS)
+	settings.update({
+		'redmine_url': redmine_url,
+		'api_key': 'benchmarks',
+		'pattern': feeds.PATTERN,
+		'custom_time_entry_field_id': TIME_ENTRY_FIELD_ID,
+		'custom_user_field_id': USER_FIELD_ID,
+		'workers': workers
+	})
+	settings['router'] = router.Router(settings)
+	# Every user has the same routes.
+	settings['matcher'] = settings['router'].matcher()
+	return settings
+
+def populate(fake, settings, arguments):
+	'''Adds the users, their feeds and the entries already in Redmine.'''
+	randomizer = random.Random(arguments.seed)
+	for number in range(arguments.users):
+		login = "user%u" % number
+		feed = feeds.generate(login, arguments.events, arguments.recurring,
+			arguments.unmatched, randomizer.random())
+		user = fake.add_user(login, feed)
+		for uid, event in events.parse([feed], settings).items():
+			if event.issue_id is None or event.rrules or \
+				randomizer.random() >= arguments.synced:
+				continue
+			entry = entries.event2entry(event, event.issue_id, {}, settings)
+			values = dict([(field, entry.attributes[field])
+				for field in ['issue_id', 'spent_on', 'hours', 'comments']])
+			values['uid'] = uid
+			if randomizer.random() < arguments.changed:
+				values['hours'] = "%.1f" % (float(values['hours']) + 0.5)
+			fake.add_entry(user['id'], values)
+		for removed in range(int(arguments.events * arguments.removed)):
+			fake.add_entry(user['id'], {
+				'issue_id': '1',
+				'spent_on': '2000-01-01',
+				'hours': '1.0',
+				'comments': 'Removed',
+				'uid': "%s-removed-%u@benchmarks" % (login, removed)
+			})
+
+def peak_memory():
+	'''The peak resident memory of the process so far, in MiB.'''
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports kilobytes, OS X bytes.
+	if sys.platform == 'darwin':
+		return peak / 1024.0 / 1024.0
+	return peak / 1024.0
+
+def measure(fake, results, stage, function):
+	'''Calls the function, recording the wall time, requests and how much it
+	raised the peak memory. The peak is that of the whole process, so a stage
+	using less memory than a stage before it doesn't raise it at all.'''
+	log.info("Benchmarking the %s ...", stage)
+	fake.reset_counts()
+	peak_before = peak_memory()
+	started = time.time()
+	result = function()
+	results.append({
+		'stage': stage,
+		'seconds': time.time() - started,
+		'requests': fake.reset_counts(),
+		'peak_growth': peak_memory() - peak_before
+	})
+	return result
+
+def run(fake, settings):
+	'''Runs the stages of a sync one at a time, for all users.'''
+	results = []
+	workers = settings['workers']
+	found_users = measure(fake, results, 'user discovery',
+		lambda: list(users.fetch(settings)))
+	sessions = dict([(user.id, redmine.impersonate_user(user))
+		for user in found_users])
+	def fetch_feed(user):
+		'''Fetches the body of a users feed.'''
+		ical_url = user.get_custom_field_value(settings['custom_user_field_id'])
+		response = transport.get_session().get(ical_url)
+		response.raise_for_status()
+		return response.content
+	bodies = measure(fake, results, 'feed fetch',
+		lambda: pool.run(fetch_feed, found_users, workers))
+	def parse_feed(body):
+		'''Parses a feed, and the UIDs of all its events.'''
+		feed_uids = set()
+		return events.parse([body], settings, feed_uids), feed_uids
+	parsed = measure(fake, results, 'parse',
+		lambda: pool.run(parse_feed, bodies, workers))
+	def fetch_entries(user):
+		'''Fetches the entries of a user, by uid.'''
+		return dict([(entry.get_custom_field_value(
+			settings['custom_time_entry_field_id']), entry)
+			for entry in entries.fetch(sessions[user.id], settings)])
+	users_entries = measure(fake, results, 'entry fetch',
+		lambda: pool.run(fetch_entries, found_users, workers))
+	def plan(index):
+		'''Plans the writes of a user.'''
+		users_events, feed_uids = parsed[index]
+		return events.plan(sessions[found_users[index].id], users_events,
+			users_entries[index], settings, feed_uids)
+	plans = measure(fake, results, 'diff',
+		lambda: pool.run(plan, range(len(found_users)), workers))
+	def write(index):
+		'''Does the planned writes of a user.'''
+		session = sessions[found_users[index].id]
+		summary, writes = plans[index]
+		return pool.run(lambda write_args: events.write(session,
+			users_entries[index], settings, *write_args), writes,
+			settings['write_workers'])
+	written = measure(fake, results, 'writes',
+		lambda: pool.run(write, range(len(found_users)), workers))
+	destinies = {}
+	for summary, writes in plans:
+		for uid, event, issue_id, destiny in writes:
+			destinies[destiny] = destinies.get(destiny, 0) + 1
+	failed = sum([len([exp for exp in exps if exp is not None])
+		for exps in written])
+	return results, destinies, failed
+
+def report(results, arguments):
+	'''Prints the results as a table.'''
+	print "%u users x %u events, %.3fs latency, %u worker(s):" % (
+		arguments.users, arguments.events, arguments.latency, arguments.workers)
+	print "%-16s %10s %10s %-32s %12s" % ('stage', 'wall (s)', 'requests',
+		'by method', 'peak +MiB')
+	for result in results:
+		requests = result['requests']
+		by_method = " ".join(["%s=%u" % (method, requests[method])
+			for method in sorted(requests.keys())])
+		print "%-16s %10.3f %10u %-32s %12.1f" % (result['stage'],
+			result['seconds'], sum(requests.values()), by_method,
+			result['peak_growth'])
+	print "%-16s %10.3f %10u %-32s %12.1f" % ('total',
+		sum([result['seconds'] for result in results]),
+		sum([sum(result['requests'].values()) for result in results]),
+		'(peak MiB)', peak_memory())
+
+def main():
+	'''Sets up the fake Redmine, runs the benchmark and reports.'''
+	arguments = parse_arguments()
+	logging.basicConfig(format='%(name)s %(levelname)s: %(message)s',
+		level=getattr(logging, arguments.log.upper()))
+	for lib_logger in ['pyactiveresource', 'requests']:
+		logging.getLogger(lib_logger).setLevel(logging.WARNING)
+	fake = FakeRedmine(arguments.latency)
+	fake.start()
+	try:
+		settings = make_settings(fake.url, arguments.workers)
+		transport.setup(settings['http_pool_size'])
+		redmine.setup(settings['redmine_url'], settings['api_key'])
+		log.info("Generating %u feeds of %u events ...", arguments.users,
+			arguments.events)
+		populate(fake, settings, arguments)
+		results, destinies, failed = run(fake, settings)
+	finally:
+		# Closing the pooled connections, ends the threads serving them.
+		transport.get_session().close()
+		fake.stop()
+	report(results, arguments)
+	print "Writes: %s, %u failed." % (", ".join(["%u %s" % (count, destiny)
+		for destiny, count in sorted(destinies.items())]), failed)
+
+if __name__ == '__main__':
+	main()
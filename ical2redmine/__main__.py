@@ -1,10 +1,15 @@
 '''A module to create/update/remove Redmine time entries from a iCal feeds.'''
-import logging, argparse, os, sys, json, re
+import os, sys
 # Append the parent directory in the system path.
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from ical2redmine import startup
+if '--startup-timing' in sys.argv:
+	# Imports are timed from here, as the rest are imported below.
+	startup.install()
+import logging, argparse, json, re
 from ical2redmine.logger import LOG as log
+from ical2redmine import clock
 from datetime import datetime, timedelta
-from dateutil.tz import tzlocal
 
 REQUIRED_SETTINGS_FIELDS = [ "redmine_url", "pattern", "api_key" ]
 
@@ -15,11 +20,27 @@ DEFAULT_SETTINGS = {
 	"ignore_events_older_than": "", # Never ignore events
 	"freeze_entries_older_than": "", # Never freeze entries.,
 	"mail_send_summary": False,
-	"mail_summary_subject": "Summary from iCal2Redmine"
+	"mail_summary_subject": "Summary from iCal2Redmine",
+	"workers": 1,
+	"fetch_workers": 4,
+	"write_workers": 4,
+	"http_pool_size": 10,
+	"feed_max_bytes": 64 * 1024 * 1024,
+	"redmine_max_rate": 0, # Requests per second, adapting without a limit.
+	"redmine_max_retries": 3,
+	"state_directory": "", # Don't keep any state between runs.
+	"state_full_refresh_days": 7,
+	"daemon_min_interval": 5 * 60, # seconds
+	"daemon_max_interval": 6 * 60 * 60, # seconds
+	"daemon_users_interval": 60 * 60, # seconds
+	"metrics_file": "", # Don't export any metrics.
+	"shard_lease_seconds": 2 * 60
 }
 
 LOG_LEVELS = [ 'debug', 'info', 'warning', 'error', 'critical' ]
 
+COMMANDS = [ 'sync', 'plan', 'apply' ]
+
 DATE_PATTERN = "(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})" # ISO
 TIMEDELTA_PATTERN = "(?P<days>\d+) ?days?" # timedelta
 
@@ -40,13 +61,47 @@ def print_logo():
 def parse_arguments():
 	'''Parsing the runtime arguments given to the tool'''
 	parser = argparse.ArgumentParser()
+	parser.add_argument('command', nargs='?', default='sync', choices=COMMANDS,
+		help='Sync the entries (default), only plan the writes or apply a plan.')
 	parser.add_argument('-s', '--settings', required=True,
 		help='The settings to use for creating time entries.')
 	parser.add_argument('-l', '--log', default='info',
 		help='Set the log level.', choices=LOG_LEVELS)
 	parser.add_argument('-ll', '--liblog', default='warning',
 		help='Set the libs log level.', choices=LOG_LEVELS)
-	return parser.parse_args()
+	parser.add_argument('-w', '--workers', type=int,
+		help='The number of users to process concurrently.')
+	parser.add_argument('-d', '--daemon', action='store_true',
+		help='Keep running, syncing every user on an adaptive interval.')
+	parser.add_argument('-p', '--plan',
+		help='The file to write the plan to, or apply the plan from.')
+	parser.add_argument('--profile', choices=['cpu', 'mem'],
+		help='Profile the CPU time or memory used processing every user.')
+	parser.add_argument('--profile-dir', default='profiles',
+		help='The directory to write the profiles to.')
+	parser.add_argument('--startup-timing', action='store_true',
+		help='Print how long the startup took, by phase and import.')
+	parser.add_argument('--shard',
+		help='Only sync the users of shard i of N (given as i/N).')
+	parser.add_argument('--shard-store',
+		help='Share the users with the other workers using this SQLite file.')
+	arguments = parser.parse_args()
+	if arguments.command != 'sync' and not arguments.plan:
+		parser.error("The %s command requires a --plan file." % arguments.command)
+	if arguments.command != 'sync' and arguments.daemon:
+		parser.error("The %s command can't be daemonized." % arguments.command)
+	if arguments.shard:
+		from ical2redmine import shard
+		try:
+			shard.parse(arguments.shard)
+		except ValueError as err:
+			parser.error(str(err))
+	if arguments.shard and arguments.shard_store:
+		parser.error("Either a --shard or a --shard-store can be given.")
+	if arguments.command == 'apply' and (arguments.shard or
+		arguments.shard_store):
+		parser.error("A plan is applied as a whole, plan every shard instead.")
+	return arguments
 
 LIB_LOGGERS = ['pyactiveresource', 'requests']
 
@@ -72,11 +127,25 @@ def bootstrap_logger(log_level, liblog_level):
 	for lib_logger in LIB_LOGGERS:
 		logging.getLogger(lib_logger).setLevel(numeric_liblog_level)
 
+# Caches the paths of the libs, as they were found the last time.
+LIBS_CACHE_FILENAME = ".libs.json"
+
 def bootstrap_libs():
-	'''Sets include path for the libs.'''
+	'''Sets include path for the libs, as they were found the last time if
+	neither the lib directory nor the build of any lib has changed since.'''
 	# What is the current directory of this file?
 	current_path = os.path.dirname(os.path.realpath(__file__))
 	libs_path = os.path.join(current_path, "..", "lib")
+	cache_path = os.path.join(current_path, "..", LIBS_CACHE_FILENAME)
+	libs_mtime = os.stat(libs_path).st_mtime
+	cached_libs = load_libs_cache(cache_path, libs_mtime)
+	if cached_libs is not None:
+		for lib, (build_mtime, lib_platform_path) in cached_libs.items():
+			unload_lib(lib)
+			log.debug("Adding lib %s to the python path.", lib_platform_path)
+			sys.path.append(lib_platform_path)
+		return
+	found_libs = {}
 	# Check if the lib has been build.
 	for lib in os.listdir(libs_path):
 		# First, onload any included libs from the path.
@@ -97,6 +166,36 @@ def bootstrap_libs():
 			lib_platform_path = os.path.join(lib_build_path, platform_folder)
 			log.debug("Adding lib %s to the python path.", lib_platform_path)
 			sys.path.append(lib_platform_path)
+			found_libs[lib] = (os.stat(lib_build_path).st_mtime, lib_platform_path)
+	save_libs_cache(cache_path, libs_mtime, found_libs)
+
+def load_libs_cache(cache_path, libs_mtime):
+	'''Loads the libs found the last time, by name. None if the cache is
+	missing or the lib directory or the build of a lib has changed since.'''
+	try:
+		with open(cache_path, 'r') as cache_handle:
+			cache = json.loads(cache_handle.read())
+		if cache['libs_mtime'] != libs_mtime:
+			return None
+		current_path = os.path.dirname(os.path.realpath(__file__))
+		for lib, (build_mtime, lib_platform_path) in cache['libs'].items():
+			lib_build_path = os.path.join(current_path, "..", "lib", lib, 'build')
+			if os.stat(lib_build_path).st_mtime != build_mtime:
+				return None
+		return cache['libs']
+	except (IOError, OSError, ValueError, KeyError, TypeError):
+		return None
+
+def save_libs_cache(cache_path, libs_mtime, found_libs):
+	'''Saves the libs found, ignoring that the cache can't be written.'''
+	try:
+		with open(cache_path, 'w') as cache_handle:
+			cache_handle.write(json.dumps({
+				'libs_mtime': libs_mtime,
+				'libs': found_libs
+			}))
+	except IOError as error:
+		log.debug("Couldn't cache the paths of the libs: %s", error)
 
 def load_settings(settings_filepath):
 	'''Loads the settings file.'''
@@ -161,10 +260,14 @@ def check_custom_field(custom_fields, field_id, field_name):
 	else:
 		raise ValueError("Either id or name of the custom field must be specified!")
 
-def convert_timedelta_settings(settings):
-	'''Convert all the timedelta settings.'''
+def convert_timedelta_settings(settings, loaded_settings=None):
+	'''Convert all the timedelta settings, from the loaded settings if given.
+	Timedeltas are relative to now, so this is done again when daemonized.'''
+	now = clock.reset()
+	if loaded_settings is None:
+		loaded_settings = settings
 	for settings_field in TIMEDELTA_SETTINGS_FIELDS:
-		settings_value = settings[settings_field]
+		settings_value = loaded_settings[settings_field]
 		date_match = re.match(DATE_PATTERN, settings_value)
 		timedelta_match = re.match(TIMEDELTA_PATTERN, settings_value)
 		if date_match:
@@ -173,10 +276,10 @@ def convert_timedelta_settings(settings):
 			month = int(date_match.group('month'))
 			day = int(date_match.group('day'))
 			settings[settings_field] = datetime( year=year, month=month, day=day,
-				tzinfo=tzlocal() )
+				tzinfo=clock.LOCAL )
 		elif timedelta_match:
 			days = int(timedelta_match.group('days'))
-			latest_datetime = datetime.now( tz=tzlocal() ) - timedelta( days=days )
+			latest_datetime = now - timedelta( days=days )
 			settings[settings_field] = latest_datetime
 		elif settings_value == "":
 			# Do it no matter the date.
@@ -187,56 +290,137 @@ def convert_timedelta_settings(settings):
 				"doesn't match the expected format, please read the "\
 				"settings.example.json or the projects README file.")
 
-def process(settings):
-	'''Start the processing of '''
-	# We should wait with the imports until now that the libs are loaded.
-	import pyactiveresource
-	# should be loaded first.
-	from ical2redmine import redmine, users
-	# Setting the API key for the active resource to use.
-	redmine.setup(settings['redmine_url'], settings['api_key'])
+def process(settings, daemonize=False, refresh_settings=None, command='sync',
+	plan_path=None, shard_argument=None, shard_store=None):
+	'''Start the processing of users, once or (daemonized) until stopped.
+	When planning, the writes are written to the plan rather than done, and no
+	state is kept. When applying, the writes are read from the plan. Given a
+	shard (i/N) or a shard store, only some of the users are processed.'''
+	with startup.phase('imports'):
+		# We should wait with the imports until now that the libs are loaded.
+		import pyactiveresource
+		# should be loaded first.
+		from ical2redmine import redmine, users, cache, transport, metrics
+		from ical2redmine import throttle
+	if shard_argument or shard_store:
+		from ical2redmine import shard
+	with startup.phase('state'):
+		if command == 'plan':
+			from ical2redmine import plan
+			settings['plan_writer'] = plan.PlanWriter(plan_path, settings)
+		elif settings['state_directory']:
+			from ical2redmine import state
+			feeds_directory = os.path.join(settings['state_directory'], 'feeds')
+			settings['feed_cache'] = cache.FeedCache(feeds_directory)
+			state_path = os.path.join(settings['state_directory'], 'state.sqlite')
+			settings['state_store'] = state.StateStore(state_path)
+			from ical2redmine import journal
+			# Shards each resume their own journal.
+			journal_name = 'journal'
+			if shard_argument:
+				journal_name += ".%uof%u" % shard.parse(shard_argument)
+			settings['journal'] = journal.acquire(settings['state_directory'],
+				journal_name)
+		elif daemonize:
+			settings['feed_cache'] = cache.MemoryFeedCache()
+		if shard_argument:
+			settings['shard'] = shard.StaticShard(*shard.parse(shard_argument))
+		elif shard_store:
+			settings['shard'] = shard.LeaseShard(shard_store,
+				settings['shard_lease_seconds'])
+		if command == 'sync' and settings['mail_send_summary']:
+			from ical2redmine import summary
+			settings['mailer'] = summary.Mailer(settings)
 	try:
-		check_custom_fields(settings, redmine.CustomFields.find())
-		# Fetch all the redmine users with iCal URLs sat.
-		all_users = users.fetch(settings)
-		log.info( "Found %u user(s) in Redmine, with the iCal Feed URL sat."
-			% len(all_users) )
-		users.process(all_users, settings)
+		with startup.phase('connecting to redmine'):
+			transport.setup(settings['http_pool_size'])
+			throttle.setup(settings['redmine_max_rate'],
+				settings['redmine_max_retries'])
+			# Setting the API key for the active resource to use.
+			redmine.setup(settings['redmine_url'], settings['api_key'])
+			check_custom_fields(settings, redmine.CustomFields.find())
+		if settings['startup_timing']:
+			startup.report()
+		if daemonize:
+			from ical2redmine import daemon
+			daemon.run(settings, refresh_settings)
+			if settings.get('journal'):
+				settings['journal'].finish()
+			return
+		if command == 'apply':
+			from ical2redmine import plan
+			done, failed = plan.apply(plan_path, settings)
+			log.info("Applied %u write(s) from the plan, %u failed.", done, failed)
+		else:
+			# Fetch the redmine users with iCal URLs sat, while processing them.
+			all_users = users.fetch(settings)
+			users_count = users.process(all_users, settings)
+			log.info( "Processed %u user(s) in Redmine, with the iCal Feed URL sat."
+				% users_count )
+		if command == 'plan':
+			settings['plan_writer'].close()
+		if settings.get('journal'):
+			settings['journal'].finish()
+		http_stats = transport.stats()
+		log.info("Made %u HTTP requests, using %u connections (%u reused).",
+			http_stats['requests'], http_stats['connections'],
+			http_stats['reused'])
+		if settings['metrics_file']:
+			metrics.write(settings['metrics_file'])
+		if settings.get('profiler'):
+			settings['profiler'].report()
 		log.info("All done ...")
 	except pyactiveresource.connection.UnauthorizedAccess as err:
 		log.error("Unauhorized access to Redmine, are you sure the api_key" \
 			" in the settings file belongs to an administrator? %s", err)
 		sys.exit(-1)
+	finally:
+		if settings.get('mailer'):
+			# The summaries queued are delivered, even if the run failed.
+			settings['mailer'].close()
+		if settings.get('shard'):
+			settings['shard'].close()
 
 def main():
 	'''This is where it all comes together.'''
-	arguments = parse_arguments()
-	print_logo()
-	bootstrap_logger(arguments.log, arguments.liblog)
-	bootstrap_libs()
-	try:
-		loaded_settings = load_settings(arguments.settings)
-		check_settings(loaded_settings)
-	except AssertionError as settings_error:
-		log.error("Invalid settings file: %s" % settings_error)
-		sys.exit(-2)
-	except ValueError as settings_error:
-		log.error("Invalid settings file: %s" % settings_error)
-		sys.exit(-2)
+	with startup.phase('arguments'):
+		arguments = parse_arguments()
+	with startup.phase('logo'):
+		print_logo()
+	with startup.phase('logger'):
+		bootstrap_logger(arguments.log, arguments.liblog)
+	with startup.phase('libraries'):
+		bootstrap_libs()
+	with startup.phase('settings'):
+		try:
+			loaded_settings = load_settings(arguments.settings)
+			check_settings(loaded_settings)
+		except AssertionError as settings_error:
+			log.error("Invalid settings file: %s" % settings_error)
+			sys.exit(-2)
+		except ValueError as settings_error:
+			log.error("Invalid settings file: %s" % settings_error)
+			sys.exit(-2)
 	settings = dict()
 	settings.update(DEFAULT_SETTINGS)
 	settings.update(loaded_settings)
-	# Compiling the pattern.
-	settings["pattern"] = re.compile(settings["pattern"])
-	assert settings["pattern"], "The pattern didn't compile."
-	issue_id_in_pattern = 'issue_id' in settings["pattern"].groupindex.keys()
-	assert issue_id_in_pattern,	"The pattern specified in the settings, " \
-		"must have a named group called 'issue_id', please visit " \
-		"http://docs.python.org/2/library/re.html#regular-expression-syntax " \
-		"for more information on how to define a regular expression pattern."
+	settings["startup_timing"] = arguments.startup_timing
+	if arguments.workers:
+		settings["workers"] = arguments.workers
+	if arguments.profile:
+		from ical2redmine import profiling
+		settings["profiler"] = profiling.Profiler(arguments.profile,
+			arguments.profile_dir)
+	# Compiling the pattern and routes.
+	from ical2redmine import router
+	settings["router"] = router.Router(settings)
+	timedelta_settings = dict([(field, settings[field])
+		for field in TIMEDELTA_SETTINGS_FIELDS])
 	convert_timedelta_settings(settings)
 	#print settings['update_entries_age_day_limit']
-	process(settings)
+	process(settings, arguments.daemon,
+		lambda: convert_timedelta_settings(settings, timedelta_settings),
+		arguments.command, arguments.plan, arguments.shard, arguments.shard_store)
 
 if __name__ == '__main__':
 	main()
\ No newline at end of file
@@ -0,0 +1,71 @@
+'''Keeps a cache of iCal feeds on disk, to tell if a feed has changed.'''
+import os, json, hashlib, time
+from ical2redmine.logger import LOG as log
+
+def key(user, url):
+	'''The key of a feed of a user. Users sharing a feed are synced (and
+	skipped) separately, so the feed is cached per user.'''
+	return u"%s %s" % (user.id, url)
+
+class FeedCache(object):
+	'''A directory of json files, one per user and feed URL, each storing the
+	ETag, Last-Modified header and a hash of the body, from the last successful
+	sync.'''
+	def __init__(self, directory):
+		self.directory = os.path.realpath(directory)
+		if not os.path.isdir(self.directory):
+			log.debug("Creating the feed cache directory '%s'.", self.directory)
+			os.makedirs(self.directory)
+
+	def path(self, user, url):
+		'''The path of the file caching the feed of the user at the url.'''
+		filename = hashlib.sha1(key(user, url).encode('utf-8')).hexdigest() + \
+			'.json'
+		return os.path.join(self.directory, filename)
+
+	def get(self, user, url):
+		'''Gets the cached record of a feed, an empty record if none exists.'''
+		try:
+			with open(self.path(user, url), 'r') as cache_handle:
+				return json.loads(cache_handle.read())
+		except (IOError, ValueError):
+			return {}
+
+	def put(self, user, url, record):
+		'''Stores the record of a feed, replacing the file atomically.'''
+		path = self.path(user, url)
+		temporary_path = "%s.%u.tmp" % (path, os.getpid())
+		with open(temporary_path, 'w') as cache_handle:
+			cache_handle.write(json.dumps(record))
+		os.rename(temporary_path, path)
+
+class MemoryFeedCache(object):
+	'''A feed cache kept in memory, when running as a daemon without a state
+	directory.'''
+	def __init__(self):
+		self.records = {}
+
+	def get(self, user, url):
+		'''Gets the cached record of a feed, an empty record if none exists.'''
+		return dict(self.records.get(key(user, url), {}))
+
+	def put(self, user, url, record):
+		'''Stores the record of a feed.'''
+		self.records[key(user, url)] = dict(record)
+
+def fingerprint(settings):
+	'''A hash of the settings, which changes how a feed is synced.'''
+	values = [
+		settings['matcher'].fingerprint,
+		settings['custom_time_entry_field_id']
+	]
+	return hashlib.sha1(json.dumps(values)).hexdigest()
+
+def is_valid(record, settings):
+	'''Can a feed, which hasn't changed since the record, safely be skipped?
+	This is not the case when the settings has changed, or when an event that
+	was ignored because it was in the future, has now ended.'''
+	if not record or record.get('fingerprint') != fingerprint(settings):
+		return False
+	due = record.get('due')
+	return due is None or due > time.time()
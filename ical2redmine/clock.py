@@ -0,0 +1,20 @@
+'''The local timezone and the current time of a run, so they are looked up
+once, instead of for every event.'''
+from datetime import datetime
+from dateutil.tz import tzlocal, tzutc
+
+LOCAL = tzlocal()
+UTC = tzutc()
+NOW = None
+
+def reset():
+	'''Starts a run, taking the current time as its now.'''
+	global NOW
+	NOW = datetime.now(LOCAL)
+	return NOW
+
+def now():
+	'''The current time, as of the start of the run.'''
+	if NOW is None:
+		return reset()
+	return NOW
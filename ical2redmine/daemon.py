@@ -0,0 +1,125 @@
+'''Keeps ical2redmine running, syncing every user on an interval of its own.'''
+import signal, threading, time, Queue
+from ical2redmine.logger import LOG as log
+from ical2redmine import users, metrics, clock
+
+class UserSchedule(object):
+	'''When a user should be synced next, and how often.
+	The interval is reset to the minimum whenever the feed has changed, and
+	doubled (up to the maximum) whenever it hasn't.'''
+	def __init__(self, user, settings):
+		self.user = user
+		self.interval = settings['daemon_min_interval']
+		self.due = time.time()
+		self.running = False
+
+	def reschedule(self, changed, settings):
+		'''Schedules the next sync, after the last one has finished.'''
+		if changed:
+			self.interval = settings['daemon_min_interval']
+		else:
+			self.interval = min(self.interval * 2,
+				settings['daemon_max_interval'])
+		self.due = time.time() + self.interval
+		log.debug("Syncing user '%s' again in %u seconds.", self.user.login,
+			self.interval)
+
+def sync(schedule, settings):
+	'''Syncs a single scheduled user, never raising.'''
+	changed = False
+	clock.reset()
+	try:
+		changed = users.process_user(schedule.user, settings)
+	except (Exception, SystemExit) as err:
+		log.exception("Error when syncing user '%s': %s", schedule.user.login,
+			err)
+	# Users of other shards are checked again soon, as they may be rebalanced.
+	schedule.reschedule(changed or changed is None, settings)
+	schedule.running = False
+	if settings.get('journal'):
+		settings['journal'].compact()
+	if settings['metrics_file']:
+		try:
+			metrics.write(settings['metrics_file'])
+		except (IOError, OSError) as err:
+			log.error("Couldn't write the metrics: %s", err)
+
+def refresh_schedules(schedules, settings):
+	'''Updates the schedules with the users currently in Redmine.'''
+	found_ids = set()
+	for user in users.fetch(settings):
+		found_ids.add(user.id)
+		if user.id in schedules:
+			schedules[user.id].user = user
+		else:
+			log.info("Scheduling user '%s'.", user.login)
+			schedules[user.id] = UserSchedule(user, settings)
+	for user_id in schedules.keys():
+		if user_id not in found_ids and not schedules[user_id].running:
+			log.info("Unscheduling user '%s'.", schedules[user_id].user.login)
+			del schedules[user_id]
+
+def run(settings, refresh_settings=None):
+	'''Runs until SIGTERM or SIGINT, syncing at most settings['workers'] users
+	at a time. The users are refetched every settings['daemon_users_interval']
+	seconds, after calling refresh_settings (if given). Syncs that have started,
+	are finished before returning.'''
+	stopping = threading.Event()
+	# Set when stopping, or when a sync has finished.
+	wakeup = threading.Event()
+	def stop(signum, frame):
+		'''Stops the daemon gracefully.'''
+		log.info("Stopping, when the running syncs has finished ...")
+		stopping.set()
+		wakeup.set()
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(signal.SIGINT, stop)
+	tasks = Queue.Queue()
+	def work():
+		'''Syncs the scheduled users taken off the queue, until a None.'''
+		while True:
+			schedule = tasks.get()
+			if schedule is None:
+				break
+			elif stopping.is_set():
+				schedule.running = False
+			else:
+				sync(schedule, settings)
+				wakeup.set()
+	workers = []
+	for number in range(max(settings['workers'], 1)):
+		worker = threading.Thread(target=work, name="worker-%u" % number)
+		worker.daemon = True
+		worker.start()
+		workers.append(worker)
+	schedules = {}
+	users_refreshed = 0
+	while not stopping.is_set():
+		now = time.time()
+		if users_refreshed + settings['daemon_users_interval'] <= now:
+			if refresh_settings:
+				refresh_settings()
+			try:
+				refresh_schedules(schedules, settings)
+			except Exception as err:
+				log.exception("Couldn't fetch the users from Redmine: %s", err)
+			users_refreshed = now
+		next_due = users_refreshed + settings['daemon_users_interval']
+		for schedule in schedules.values():
+			if schedule.running:
+				continue
+			if schedule.due <= now:
+				schedule.running = True
+				tasks.put(schedule)
+			else:
+				next_due = min(next_due, schedule.due)
+		# Wake up when the next user is due, a sync has finished or stopping.
+		wakeup.wait(max(next_due - time.time(), 1))
+		wakeup.clear()
+	for worker in workers:
+		tasks.put(None)
+	# Joining with a timeout, keeps the main thread responsive to signals.
+	for worker in workers:
+		while worker.is_alive():
+			worker.join(1)
+	log.info("Stopped.")
@@ -1,19 +1,20 @@
 '''Determines an events destiny: skipped, created, updated or deleted?'''
-import dateutil.parser
-from dateutil.tz import tzlocal
 from ical2redmine.logger import LOG as log
 from ical2redmine.entries import event2entry
+from ical2redmine import state, clock
 from datetime import datetime
 
 DESTINY_SKIP = 'skipped'
 DESTINY_CREATE = 'created'
 DESTINY_UPDATE = 'updated'
 DESTINY_DELETE = 'deleted'
+DESTINIES = [ DESTINY_SKIP, DESTINY_CREATE, DESTINY_UPDATE, DESTINY_DELETE ]
 
 def entry_freezed(entry, settings):
 	'''Tests if an entry is too old to be deleted or updated.'''
 	if settings['freeze_entries_older_than'] == "":
 		return False
+	import dateutil.parser
 	spent_on = dateutil.parser.parse(entry.spent_on)
 	if settings['freeze_entries_older_than'].replace(tzinfo=None) > spent_on:
 		log.debug("Entry freezed because it's too old.")
@@ -26,8 +27,8 @@ def event_ignored(event, settings):
 	if settings['ignore_events_older_than'] == "":
 		return False
 	else:
-		too_old = settings['ignore_events_older_than'] > event.get('DTSTART').dt
-		in_future = event.get('DTEND').dt > datetime.now( tzlocal() )
+		too_old = settings['ignore_events_older_than'] > event.start
+		in_future = event.end > clock.now()
 		if too_old:
 			log.debug("Event ignored because it's too old.")
 			return True
@@ -37,13 +38,83 @@ def event_ignored(event, settings):
 		else:
 			return False
 
-def has_event_changed(event, entry1, issue_id, settings):
-	'''Test if event has changed'''
+def next_due(matching_events, settings):
+	'''Finds the earliest end of the events ignored for being in the future.
+	Until then, these events won't change destiny by time passing alone.'''
+	if settings['ignore_events_older_than'] == "":
+		return None
+	now = clock.now()
+	result = None
+	for event, issue_id in matching_events.values():
+		end = event.end
+		if isinstance(end, datetime) and end > now:
+			if result is None or end < result:
+				result = end
+	return result
+
+def occurrence_start(uid, recurring_event):
+	'''The start of the occurrence of a recurring event, an entry was written
+	for: the first one if the uid is the event's, otherwise the one in the uid.
+	None if it can't be told.'''
+	if '#' not in uid:
+		start = recurring_event.start
+		if start.tzinfo is None:
+			start = start.replace(tzinfo=clock.LOCAL)
+		return start
+	try:
+		return datetime.strptime(uid.split('#', 1)[1], "%Y%m%dT%H%M%SZ").replace(
+			tzinfo=clock.UTC)
+	except ValueError:
+		return None
+
+def find_orphans(users_entries, feed_uids, settings, recurring_events=None,
+	occurrence_uids=None, since=None):
+	'''Finds the uids of entries whose event has been removed from the feed,
+	and which are not too old to be deleted. Occurrences of the recurring
+	events given (by uid) which were expanded from since until now, are removed
+	if they are not among the occurrence_uids (as they were cancelled by an
+	EXDATE or a shorter RRULE). Occurrences of other recurring events are kept,
+	for as long as the recurring event is in the feed. Nothing is found if the
+	feed is empty, which is more likely an error than a cleared calendar.'''
+	if not feed_uids:
+		log.warning("The iCal feed has no events, not looking for removed ones.")
+		return []
+	recurring_events = recurring_events or {}
+	now = clock.now()
+	result = []
+	for uid in set(users_entries.keys()) - (occurrence_uids or set()):
+		master_uid = uid.split('#', 1)[0]
+		if master_uid in recurring_events:
+			start = occurrence_start(uid, recurring_events[master_uid])
+			if start is None or start > now or (since and start < since):
+				# Outside of the expansion, it can't be told.
+				continue
+		elif master_uid in feed_uids:
+			continue
+		if not entry_freezed(users_entries[uid], settings):
+			result.append(uid)
+	return sorted(result)
+
+def has_event_changed(event, entry1, issue_id, settings, fingerprints=None):
+	'''Test if event has changed, if known fingerprints of entries are given,
+	an event with the same SEQUENCE and LAST-MODIFIED as when the entry was
+	last written, is known not to have changed.'''
+	if fingerprints and int(entry1.id) in fingerprints:
+		known_fingerprint = fingerprints[int(entry1.id)]
+		event_fingerprint = state.fingerprint(event, issue_id, entry1,
+			settings['custom_time_entry_field_id'])
+		if event_fingerprint == known_fingerprint:
+			log.debug("Event wasn't changed, since the entry was written.")
+			return False
 	entry2 = event2entry(event, issue_id, {}, settings)
 	changed_spent_on = entry1.spent_on != entry2.spent_on
 	changed_hours = entry1.hours != entry2.hours
 	changed_comments = entry1.comments != entry2.comments
 	changed_issue_id = entry1.issue.id != entry2.issue_id
+	# Entries whose activity isn't known, have none to compare.
+	changed_activity_id = event.activity_id is not None and \
+		entry1.attributes.get('activity') is not None and \
+		unicode(entry1.activity.id) != unicode(event.activity_id)
 	if changed_spent_on:
 		log.debug("Event has changed the spent_on value.")
 		return True
@@ -56,11 +127,15 @@ def has_event_changed(event, entry1, issue_id, settings):
 	elif changed_issue_id:
 		log.debug("Event has changed the issue_id value.")
 		return True
+	elif changed_activity_id:
+		log.debug("Event has changed the activity_id value.")
+		return True
 	else:
 		log.debug("Event wasn't changed.")
 		return False
 
-def determine_event_destiny(event, issue_id, users_entries, settings):
+def determine_event_destiny(event, issue_id, users_entries, settings,
+	fingerprints=None):
 	'''Determines an events destiny, should it be created, updated or deleted?
 	* An entry should be created if:
 	  1. The event is not already represented in Redmine,
@@ -82,30 +157,31 @@ def determine_event_destiny(event, issue_id, users_entries, settings):
 	  3. The event has been removed from the feed,
 	'''
 	# Make sure that these are in fact datetimes, I suppose if dates are returned
-	# as .dt attribute, the event is a full-day event.
-	if not isinstance(event.get('DTSTART').dt, datetime):
+	# the event is a full-day event.
+	if not isinstance(event.start, datetime):
 		log.warning("Skipping an event: As the events DTSTART is a date"\
 		" (creating entries for full-day event doesn't make sence)")
 		return DESTINY_SKIP
-	if not isinstance(event.get('DTEND').dt, datetime):
+	if not isinstance(event.end, datetime):
 		log.warning("Skipping an event: As the events DTEND is a date"\
 		" (creating entries for full-day event doesn't make sence)")
 		return DESTINY_SKIP
 	# Derive predicates
-	is_represented = unicode(event.get('UID')) in users_entries.keys()
+	is_represented = event.uid in users_entries.keys()
 	# TODO: Consider if it should be end or start dates used here.
 	event_is_ignored = event_ignored(event, settings)
 	if not is_represented and event_is_ignored:
 		destiny = DESTINY_SKIP
 	elif is_represented:
-		entry = users_entries[unicode(event.get('UID'))]
+		entry = users_entries[event.uid]
 		entry_is_freezed = entry_freezed(entry, settings)
 		if entry_is_freezed:
 			destiny = DESTINY_SKIP
 		elif event_is_ignored:
 			destiny = DESTINY_DELETE
 		else:
-			event_has_changed = has_event_changed(event, entry, issue_id, settings)
+			event_has_changed = has_event_changed(event, entry, issue_id, settings,
+				fingerprints)
 			if event_has_changed:
 				destiny = DESTINY_UPDATE
 			else:
@@ -1,38 +1,117 @@
 '''This module fetches, creates, updates and removes time entries in Redmine.'''
 from ical2redmine.logger import LOG as log
 from ical2redmine.redmine import TimeEntries
+from ical2redmine import redmine, pool, metrics
 
-def fetch(user, settings):
-	'''Fetches time entries from Redmine.'''
+def fetch_since(settings):
+	'''The earliest date an entry can be spent on, and still make a difference.
+	Older entries are either freezed, or both freezed and representing events
+	that are ignored. Returns None if all entries can make a difference.'''
+	ignore_older_than = settings['ignore_events_older_than']
+	freeze_older_than = settings['freeze_entries_older_than']
+	if ignore_older_than == "" or freeze_older_than == "":
+		return None
+	return min(ignore_older_than, freeze_older_than)
+
+def fetch(session, settings, updated_since=None):
+	'''Fetches time entries from Redmine, optionally only the ones updated
+	since a date (YYYY-MM-DD).'''
+	user = session.user
 	custom_field_id = settings['custom_time_entry_field_id']
+	# Let Redmine filter out the entries that has been manually created.
+	query = {
+		'user_id': user.id,
+		'limit': redmine.PAGE_SIZE,
+		'cf_%u' % custom_field_id: '*'
+	}
+	since = fetch_since(settings)
+	if since:
+		query['from'] = since.strftime("%Y-%m-%d")
+	if updated_since:
+		query['updated_on'] = '>=' + updated_since
+	total_count = redmine.count(session.TimeEntries, **query)
+	if total_count is None:
+		pages = fetch_pages(session, query)
+	else:
+		log.debug("Fetching %u entries from Redmine.", total_count)
+		offsets = range(0, total_count, redmine.PAGE_SIZE)
+		pages = pool.run(
+			lambda offset: fetch_page(session, query, offset),
+			offsets, settings['fetch_workers'])
 	result = []
-	offset = 0
-	while True:
-		entries = TimeEntries.find( user_id=user.id, offset=offset )
-		offset += len(entries)
+	for entries in pages:
 		for entry in entries:
-			# Filter out the entries that has been manually created.
+			# Filter out the entries that has been manually created, in case the
+			# Redmine didn't know the custom field filter.
 			if entry.created_by_ical2redmine(custom_field_id):
 				result.append(entry)
+	return result
+
+# The UIDs looked up per request by fetch_by_uids, keeping the URLs short.
+UIDS_PER_REQUEST = 20
+
+def fetch_by_uids(session, settings, uids):
+	'''Fetches the time entries of events by their UIDs, whatever day they are
+	spent on. These can be older than the entries fetched by fetch, when their
+	event has been moved since.'''
+	custom_field_id = settings['custom_time_entry_field_id']
+	uids = sorted(uids)
+	wanted = set(uids)
+	def fetch_uids(batch):
+		'''Fetches the entries of a batch of UIDs, in as many pages as needed.'''
+		query = {
+			'user_id': session.user.id,
+			'limit': redmine.PAGE_SIZE,
+			'cf_%u' % custom_field_id: u'|'.join(batch)
+		}
+		return list(fetch_pages(session, query))
+	batches = [uids[offset:offset + UIDS_PER_REQUEST]
+		for offset in range(0, len(uids), UIDS_PER_REQUEST)]
+	result = []
+	for pages in pool.run(fetch_uids, batches, settings['fetch_workers']):
+		for entries in pages:
+			for entry in entries:
+				# Filter out the other entries, in case the Redmine didn't know the
+				# custom field filter.
+				if entry.created_by_ical2redmine(custom_field_id) and \
+					entry.get_custom_field_value(custom_field_id) in wanted:
+					result.append(entry)
+	return result
+
+def fetch_page(session, query, offset):
+	'''Fetches a single page of time entries.'''
+	with metrics.timed('entries_fetch_page', session.user.login):
+		return session.TimeEntries.find( offset=offset, **query )
+
+def fetch_pages(session, query):
+	'''Fetches pages of time entries one by one, until an empty one.'''
+	offset = 0
+	while True:
+		entries = fetch_page(session, query, offset)
+		offset += len(entries)
 		# If we are not getting any more entries.
 		if len(entries) == 0:
 			break
-	return result
+		yield entries
 
 COMMENT_MAX_LENGTH = 255
 
-def event2entry(event, issue_id, known_entries, settings):
-	'''Maps an event into an entry, without saving it.'''
-	event_uid = unicode(event.get('UID'))
-	delta = event.get('DTEND').dt-event.get('DTSTART').dt
+def event2entry(event, issue_id, known_entries, settings, session=None):
+	'''Maps an event into an entry, without saving it.
+	If a session is given, the entry will be saved through that session.'''
+	event_uid = event.uid
+	delta = event.end-event.start
 	delta_hours = delta.total_seconds() / 3600.0 # 60 secs * 60 minutes in an hour
 	# Check if the UID is in the known entries.
-	entry = TimeEntries()
+	if session:
+		entry = session.TimeEntries()
+	else:
+		entry = TimeEntries()
 	if event_uid in known_entries.keys():
 		# Update this 'new' time entry with the values (including id)
 		# of any known entries.
 		entry.attributes.update(known_entries[event_uid].attributes)
-	trimmed_comment = unicode(event.get('DESCRIPTION'))
+	trimmed_comment = unicode(event.description)
 	if len(trimmed_comment) > COMMENT_MAX_LENGTH:
 		postfix = " [...]"
 		trimmed_comment = trimmed_comment[:COMMENT_MAX_LENGTH-1-len(postfix)]
@@ -40,21 +119,23 @@ def event2entry(event, issue_id, known_entries, settings):
 	# This is where we handle repeats, events too old or in the future.
 	entry.attributes.update({
 	 	'issue_id': issue_id,
-	 	'spent_on': event.get('DTSTART').dt.strftime("%Y-%m-%d"),
+	 	'spent_on': event.start.strftime("%Y-%m-%d"),
 	 	'hours': "%.1f" % delta_hours,
 	 	'comments': trimmed_comment,
 	 	'custom_fields': [{
 	 		"id": unicode(settings['custom_time_entry_field_id']),
-	 		"value": unicode(event.get('UID'))
+	 		"value": event.uid
 	 	}]
 	})
+	if event.activity_id is not None:
+		entry.attributes['activity_id'] = event.activity_id
 	if entry.attributes['comments'] == "":
 		entry.attributes['comments'] = None
 	return entry
 
-def create(event, issue_id, known_entries, settings):
+def create(session, event, issue_id, known_entries, settings):
 	'''Creates time entries in Redmine from an event.'''
-	entry = event2entry(event, issue_id, known_entries, settings)
+	entry = event2entry(event, issue_id, known_entries, settings, session)
 	assert entry, "Something went wrong when mapping the event 2 entry."
 	if not entry.id:
 		created = entry.save()
@@ -66,9 +147,9 @@ def create(event, issue_id, known_entries, settings):
 		log.warning("Was asked to create an entry for an event that already exists!")
 		return entry
 
-def update(event, issue_id, known_entries, settings):
+def update(session, event, issue_id, known_entries, settings):
 	'''Updates time entries in Redmine.'''
-	entry = event2entry(event, issue_id, known_entries, settings)
+	entry = event2entry(event, issue_id, known_entries, settings, session)
 	assert entry.id, "Update failed, as no entry existed already. Use create!"
 	updated = entry.save()
 	if updated:
@@ -76,9 +157,8 @@ def update(event, issue_id, known_entries, settings):
 	else:
 		return None
 
-def delete(event, users_entries): #entry
-	'''Removes time entries in Redmine from an event.'''
-	uid = unicode(event.get('UID'))
+def delete(uid, users_entries): #entry
+	'''Removes the time entry in Redmine of an event, by its uid.'''
 	if uid in users_entries.keys():
 		return users_entries[uid].destroy()
 	else:
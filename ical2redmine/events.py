@@ -1,121 +1,644 @@
 '''This module fetches and processes events from an iCal feed.'''
-import requests, icalendar
+import hashlib, calendar, time, collections, threading
 from ical2redmine.logger import LOG as log
-from datetime import datetime
-from ical2redmine import entries, destinator
-from dateutil.tz import tzlocal
-from pyactiveresource.connection import ForbiddenAccess
-
-def localize_timezones(event):
-	'''Makes sure all date and datetimes are in the local timezone.'''
-	for field_name, field_value in event.items():
-		if isinstance(field_value, icalendar.prop.vDDDTypes):
-			# Is this infact a datetime?
-			if isinstance(field_value.dt, datetime):
-				event[field_name].dt = field_value.dt.astimezone( tzlocal() )
-	return event
-
-def fetch(ical_url):
-	'''Fetches events from an iCal feed.'''
+from datetime import datetime, timedelta
+from ical2redmine import entries, destinator, parser, state, pool, transport
+from ical2redmine import metrics, clock
+from pyactiveresource.connection import ForbiddenAccess, ResourceNotFound
+
+class EventRecord(object):
+	'''The fields of an event, which are used when syncing it.
+	The dtstart and dtend are dates or datetimes as in the feed, the start and
+	end are the same in the local timezone (unless the event recurs, as it's
+	expanded in its own timezone) which are localized when first used. The
+	RRULEs are kept as strings, the RDATEs and EXDATEs as tuples of datetimes.
+	The issue_id and activity_id are where the summary was routed to, both None
+	if it wasn't. The uid of an event overriding an occurrence (with a
+	RECURRENCE-ID) is followed by #recurrance, like the occurrence's.'''
+	__slots__ = ('uid', 'summary', 'description', 'dtstart', 'dtend',
+		'sequence', 'last_modified', 'recurrence_id', 'rrules', 'rdates',
+		'exdates', 'issue_id', 'activity_id', 'localized_start', 'localized_end')
+
+	def __init__(self, uid, summary, description, start, end, sequence=None,
+		last_modified=None, recurrence_id=None, rrules=(), rdates=(),
+		exdates=(), issue_id=None, activity_id=None):
+		self.uid = uid
+		self.summary = summary
+		self.description = description
+		self.dtstart = start
+		self.dtend = end
+		self.localized_start = None
+		self.localized_end = None
+		self.sequence = sequence
+		self.last_modified = last_modified
+		self.recurrence_id = recurrence_id
+		self.rrules = rrules
+		self.rdates = rdates
+		self.exdates = exdates
+		self.issue_id = issue_id
+		self.activity_id = activity_id
+
+	@property
+	def start(self):
+		'''The start, localized when first used.'''
+		if self.localized_start is None and self.dtstart is not None:
+			self.localized_start = self.dtstart if self.rrules \
+				else localize(self.dtstart)
+		return self.localized_start
+
+	@property
+	def end(self):
+		'''The end, localized when first used.'''
+		if self.localized_end is None and self.dtend is not None:
+			self.localized_end = self.dtend if self.rrules \
+				else localize(self.dtend)
+		return self.localized_end
+
+	def digest(self):
+		'''A hash of the fields, which decides the occurrences of the event.'''
+		return hashlib.sha1(repr((self.uid, self.dtstart, self.dtend, self.rrules,
+			self.rdates, self.exdates))).hexdigest()
+
+def localize(value):
+	'''Makes sure a datetime is in the local timezone, floating datetimes are
+	considered local already. Dates are returned as they are.'''
+	if isinstance(value, datetime):
+		return with_timezone(value, clock.LOCAL).astimezone(clock.LOCAL)
+	return value
+
+class CalendarTimezones(object):
+	'''The timezones defined by the VTIMEZONEs of a calendar, which are looked
+	up once per TZID. The icalendar parser only knows the timezones of the tz
+	database (and Windows names for them), the rest are looked up here.'''
+	def __init__(self):
+		self.definitions = {}
+		self.timezones = {}
+
+	def get(self, tzid):
+		'''The timezone of a TZID, None if the calendar doesn't define it.'''
+		if tzid not in self.timezones:
+			self.timezones[tzid] = self.lookup(tzid)
+		return self.timezones[tzid]
+
+	def lookup(self, tzid):
+		'''Builds the timezone from the lines of its VTIMEZONE.'''
+		import icalendar
+		lines = self.definitions.get(tzid)
+		if lines is None:
+			log.warning("The timezone '%s' isn't defined in the calendar, "
+				"considering it local.", tzid)
+			return None
+		try:
+			return icalendar.Timezone.from_ical(u"\r\n".join(lines)).to_tz()
+		except Exception as err:
+			log.warning("Couldn't read the timezone '%s', considering it local: %s",
+				tzid, err)
+			return None
+
+	def resolve(self, value, tzid):
+		'''Puts a floating datetime into the timezone of a TZID, as the
+		icalendar parser leaves it floating if the TZID was unknown to it.'''
+		if not tzid or not isinstance(value, datetime) or value.tzinfo:
+			return value
+		tzinfo = self.get(tzid)
+		if tzinfo is None:
+			return value
+		if hasattr(tzinfo, 'localize'):
+			return tzinfo.localize(value)
+		return value.replace(tzinfo=tzinfo)
+
+def ical2record(event, route=None, timezones=None):
+	'''Maps a parsed icalendar event into a record, keeping only the fields
+	used, so the icalendar event can be dropped right away. The route is the
+	(issue_id, activity_id) of the event, if its summary was routed. Datetimes
+	in timezones unknown to icalendar, are looked up in the timezones of the
+	calendar.'''
+	def resolve(value, tzid):
+		'''The datetime in the timezone of the TZID, if it's defined.'''
+		if timezones is None:
+			return value
+		return timezones.resolve(value, tzid)
+	def datetime_of(field_name):
+		'''The date or datetime of a field, None if it's not set.'''
+		field_value = event.get(field_name)
+		if field_value is None:
+			return None
+		return resolve(field_value.dt, field_value.params.get('TZID'))
+	def datetimes(field_name):
+		'''The datetimes of a field, which can occur more than once.'''
+		return tuple([resolve(value.dt, values.params.get('TZID'))
+			for values in as_list(event.get(field_name))
+			for value in values.dts if isinstance(value.dt, datetime)])
+	summary = event.get('SUMMARY')
+	description = event.get('DESCRIPTION')
+	start = datetime_of('DTSTART')
+	end = datetime_of('DTEND')
+	if end is None and event.get('DURATION') and start is not None:
+		end = start + event.get('DURATION').dt
+	sequence = event.get('SEQUENCE')
+	last_modified = event.get('LAST-MODIFIED')
+	recurrence_id = datetime_of('RECURRENCE-ID')
+	rrules = tuple([recur.to_ical() for recur in as_list(event.get('RRULE'))])
+	uid = unicode(event.get('UID'))
+	if recurrence_id:
+		# The override gets an entry of its own, apart from the recurring event.
+		uid += "#" + recurrance_key(recurrence_id)
+	return EventRecord(
+		uid,
+		summary if summary is None else unicode(summary),
+		description if description is None else unicode(description),
+		start,
+		end,
+		sequence if sequence is None else int(sequence),
+		last_modified and last_modified.to_ical(),
+		recurrence_id,
+		rrules,
+		datetimes('RDATE'),
+		datetimes('EXDATE'),
+		*(route or ())
+	)
+
+# The size of the chunks in which a feed is read.
+CHUNK_SIZE = 64 * 1024
+
+def fetch(ical_url, settings, cached=None, uids=None):
+	'''Fetches events matching the pattern, from an iCal feed.
+	If a (non-empty) cached record of the feed is given, the feed is fetched
+	conditionally and None is returned if it hasn't changed since. The record is
+	updated with the new validators, it's up to the caller to store it.
+	The UIDs of all events in the feed, matching or not, are added to uids.'''
 	log.debug("Fetching ical feeds from %s." % ical_url)
-	response = requests.get(ical_url)
-	calendar = icalendar.Calendar.from_ical(response.text)
-	name = calendar.get('X-WR-CALNAME')
-	description = calendar.get('X-WR-CALDESC')
+	headers = {}
+	conditional = bool(cached)
+	if conditional:
+		if cached.get('etag'):
+			headers['If-None-Match'] = cached['etag']
+		if cached.get('last_modified'):
+			headers['If-Modified-Since'] = cached['last_modified']
+	started = time.time()
+	response = transport.get_session().get(ical_url, headers=headers,
+		stream=True)
+	# The seconds spent waiting for the feed, rather than parsing it.
+	waited = [time.time() - started]
+	try:
+		if conditional and response.status_code == 304:
+			log.debug("The feed was not modified since it was last fetched.")
+			return None
+		response.raise_for_status()
+		content_hash = hashlib.sha1()
+		chunks = read_chunks(response, content_hash, settings['feed_max_bytes'],
+			waited)
+		result = parse(chunks, settings, uids)
+		metrics.observe('ical_parse', time.time() - started - waited[0])
+	finally:
+		response.close()
+		metrics.observe('feed_fetch', waited[0])
+	content_hash = content_hash.hexdigest()
+	if conditional and cached.get('hash') == content_hash:
+		log.debug("The feed is identical to when it was last fetched.")
+		return None
+	if cached is not None:
+		cached.update({
+			'etag': response.headers.get('ETag'),
+			'last_modified': response.headers.get('Last-Modified'),
+			'hash': content_hash
+		})
+	return result
+
+def parse(chunks, settings, uids=None):
+	'''Parses the events routed by settings['matcher'], from chunks of an iCal
+	feed, into records by their key. The UIDs of all events in the feed, routed
+	or not, are added to uids.'''
+	# Imported when needed, as it's slow to import.
+	import icalendar
+	properties = {}
+	timezones = CalendarTimezones()
+	result = dict()
+	for event_lines, route in parser.iter_events(parser.iter_lines(chunks),
+		properties, settings["matcher"], uids, timezones.definitions):
+		# A single broken event mustn't stop the others from being synced.
+		try:
+			event = ical2record(icalendar.Event.from_ical(
+				u"\r\n".join(event_lines)), route, timezones)
+			result[event_key(event)] = event
+		except Exception as err:
+			log.warning("Skipping an event, which couldn't be read: %s", err)
+	name = properties.get('X-WR-CALNAME')
+	description = properties.get('X-WR-CALDESC')
 	if name and description:
 		log.debug("Fetched calendar: '%s' (%s).", name, description)
 	elif name:
 		log.debug("Fetched calendar: '%s'.", name)
 	else:
 		log.debug("Fetched calendar!")
-	result = dict()
-	for event in calendar.walk("VEVENT"):
-		event = localize_timezones(event)
-		result[str(event.get('UID'))] = event
 	return result
 
+def read_chunks(response, content_hash, max_bytes, waited=None):
+	'''Yields the (decompressed) body of a response in chunks, updating the
+	hash as it goes, and failing if the body grows larger than max_bytes.
+	The seconds spent reading are added to waited[0], if given.'''
+	read_bytes = 0
+	chunks = response.iter_content(CHUNK_SIZE)
+	while True:
+		started = time.time()
+		chunk = next(chunks, None)
+		if waited is not None:
+			waited[0] += time.time() - started
+		if chunk is None:
+			break
+		read_bytes += len(chunk)
+		metrics.count('http_response_bytes', len(chunk))
+		if max_bytes and read_bytes > max_bytes:
+			raise ValueError("The iCal feed is larger than %u bytes." % max_bytes)
+		content_hash.update(chunk)
+		yield chunk
+
+def event_key(event):
+	'''The key of an event, its uid, which for an override is followed by the
+	recurrance it overrides.'''
+	return event.uid
+
+def recurrance_key(start):
+	'''Identifies an occurrence by its start, in UTC as in a RECURRENCE-ID.
+	Floating starts are considered local, as when expanding the occurrences.'''
+	if isinstance(start, datetime):
+		return with_timezone(start, clock.LOCAL).astimezone(clock.UTC).strftime(
+			"%Y%m%dT%H%M%SZ")
+	return start.strftime("%Y%m%d")
+
 def find_recurring_events(in_events):
 	'''This function finds recurrances of events'''
 	result = {}
 	for uid, (event, issue_id) in in_events.items():
-		if event.get('RRULE'): # TODO: Need to implement support for this.
-			rrule = event.get('RRULE')
+		if event.rrules:
 			result[uid] = (event, issue_id)
 	return result
 
-def expand_recurrances(recurring_events, start=False, end=None ):
-	'''This function expands recurrances of events, within a time interval'''
+def as_list(value):
+	'''Properties that occur more than once, are parsed into lists.'''
+	if value is None:
+		return []
+	elif isinstance(value, list):
+		return value
+	else:
+		return [value]
+
+def with_timezone(value, tzinfo):
+	'''Floating datetimes are considered to be in the given timezone.'''
+	if value.tzinfo is None:
+		return value.replace(tzinfo=tzinfo)
+	return value
+
+# The periods of the frequencies, a rule can skip ahead by whole periods of.
+# Longer periods vary in length, and are few anyway.
+FIXED_PERIODS = {
+	'WEEKLY': timedelta(weeks=1),
+	'DAILY': timedelta(days=1),
+	'HOURLY': timedelta(hours=1),
+	'MINUTELY': timedelta(minutes=1),
+	'SECONDLY': timedelta(seconds=1)
+}
+
+def skip_ahead(recur, dtstart, start):
+	'''The start to expand an RRULE from, to find its occurrences from start:
+	its DTSTART moved ahead by whole intervals, to just before start. Moving by
+	whole intervals keeps the occurrences (which are in the DTSTART's wall
+	clock time), unless the rule has a COUNT, which counts from the DTSTART.'''
+	parts = dict([part.split('=', 1) for part in recur.split(';')
+		if '=' in part])
+	period = FIXED_PERIODS.get(parts.get('FREQ'))
+	if period is None or 'COUNT' in parts or start <= dtstart:
+		return dtstart
+	interval = period * int(parts.get('INTERVAL', 1))
+	wall_start = start.astimezone(dtstart.tzinfo).replace(tzinfo=None)
+	# Two intervals early, as the wall clock may shift with daylight saving.
+	intervals = int((wall_start - dtstart.replace(tzinfo=None)).total_seconds()
+		// interval.total_seconds()) - 2
+	if intervals <= 0:
+		return dtstart
+	return dtstart + intervals * interval
+
+def build_rruleset(event, start=None):
+	'''Builds the set of RRULEs, RDATEs and EXDATEs of an event. If a start is
+	given, the occurrences before it may be left out.'''
+	from dateutil import rrule
+	dtstart = with_timezone(event.start, clock.LOCAL)
+	result = rrule.rruleset()
+	for recur in event.rrules:
+		rule_start = dtstart
+		if start is not None:
+			rule_start = skip_ahead(recur, dtstart, start)
+		result.rrule(rrule.rrulestr(recur, dtstart=rule_start))
+	for rdate in event.rdates:
+		result.rdate(with_timezone(rdate, dtstart.tzinfo))
+	for exdate in event.exdates:
+		result.exdate(with_timezone(exdate, dtstart.tzinfo))
+	return result
+
+def iter_recurrances(event, start=None):
+	'''Lazily yields the starts of the occurrences of a recurring event, from
+	start (or from the beginning, if None). The rules are expanded from just
+	before start, so the cost doesn't grow with the age of the event.'''
+	rruleset = build_rruleset(event, start)
+	if start is None:
+		return iter(rruleset)
+	return rruleset.xafter(start, inc=True)
+
+# Expanded recurrances, when no state store is kept. Only the most recently
+# used are kept, as a daemon keeps expanding new ones.
+EXPANSIONS = collections.OrderedDict()
+EXPANSIONS_MAX = 1000
+EXPANSIONS_LOCK = threading.Lock()
+
+def get_expansion(key):
+	'''Gets an expansion kept in memory, None if unknown.'''
+	with EXPANSIONS_LOCK:
+		expansion = EXPANSIONS.pop(key, None)
+		if expansion is not None:
+			EXPANSIONS[key] = expansion
+		return expansion
+
+def put_expansion(key, expansion):
+	'''Keeps an expansion in memory, dropping the least recently used.'''
+	with EXPANSIONS_LOCK:
+		EXPANSIONS.pop(key, None)
+		EXPANSIONS[key] = expansion
+		while len(EXPANSIONS) > EXPANSIONS_MAX:
+			EXPANSIONS.popitem(last=False)
+
+def find_recurrances(event, start, end, settings):
+	'''Finds the starts of the occurrences of a recurring event, from start
+	until end, and the start of the next occurrence after end (None if none).
+	The expansion is cached, until the next occurrence has started.'''
+	state_store = settings.get('state_store')
+	key = event.digest()
+	start_timestamp = start and calendar.timegm(start.utctimetuple())
+	end_timestamp = calendar.timegm(end.utctimetuple())
+	if state_store:
+		cached = state_store.get_expansion(key)
+	else:
+		cached = get_expansion(key)
+	tzinfo = with_timezone(event.start, clock.LOCAL).tzinfo
+	if cached and (cached['since'] is None or
+		(start_timestamp is not None and cached['since'] <= start_timestamp)) \
+		and (cached['next'] is None or cached['next'] > end_timestamp):
+		log.debug("Using the cached expansion of the recurring event.")
+		occurrences = [datetime.fromtimestamp(timestamp, tzinfo)
+			for timestamp in cached['starts']
+			if start_timestamp is None or timestamp >= start_timestamp]
+		if cached['next'] is None:
+			return occurrences, None
+		return occurrences, datetime.fromtimestamp(cached['next'], tzinfo)
+	occurrences = []
+	next_occurrence = None
+	for occurrence in iter_recurrances(event, start):
+		if occurrence > end:
+			next_occurrence = occurrence
+			break
+		occurrences.append(occurrence)
+	cached = {
+		'since': start_timestamp,
+		'starts': [calendar.timegm(occurrence.utctimetuple())
+			for occurrence in occurrences],
+		'next': next_occurrence and calendar.timegm(next_occurrence.utctimetuple())
+	}
+	if state_store:
+		state_store.put_expansion(key, cached)
+	else:
+		put_expansion(key, cached)
+	return occurrences, next_occurrence
+
+def recurrance2event(event, occurrence, uid):
+	'''Creates an event for a single occurrence of a recurring event.'''
+	duration = event.end - event.start
+	return EventRecord(uid, event.summary, event.description,
+		occurrence, occurrence + duration, event.sequence,
+		event.last_modified, issue_id=event.issue_id,
+		activity_id=event.activity_id)
+
+def expand_recurrances(recurring_events, overrides, settings, start=None,
+	end=None, expanded=None):
+	'''This function expands recurrances of events, within a time interval.
+	The occurrences gets the UID of the event followed by #recurrance, except
+	the first occurrence, which keeps the UID of the event. Occurrences which
+	are overridden (by events with a RECURRENCE-ID) are left out.
+	Returns the occurrences and the start of the next one after end. The UIDs
+	of the events expanded (with or without occurrences) are added to
+	expanded.'''
 	if end == None:
 		# Use now as the default value.
-		end = datetime.now(tzlocal())
-	log.error("The expand rrules functionality has not yet been implemented.")
+		end = clock.now()
 	result = {}
-	for (event, issue_id) in recurring_events.values():
-		log.debug("RRULE found!")
-		rrule = event.get('RRULE')
-		#for recurrance in recurrances:
-		# TODO: Do something about this.
-		#	result[uid + "#" + recurrance] = (event, issue_id)
-	return result
+	next_start = None
+	for uid, (event, issue_id) in recurring_events.items():
+		if not isinstance(event.start, datetime) or event.end is None:
+			log.debug("Not expanding the recurring full-day or endless event "
+				"(uid=%s).", uid)
+			continue
+		# A single broken event mustn't stop the others from being synced.
+		try:
+			occurrences, next_occurrence = find_recurrances(event, start, end,
+				settings)
+			first_key = recurrance_key(event.start)
+			occurrence_events = {}
+			for occurrence in occurrences:
+				key = recurrance_key(occurrence)
+				if uid + "#" + key in overrides:
+					continue
+				occurrence_uid = uid if key == first_key else uid + "#" + key
+				occurrence_events[occurrence_uid] = (
+					recurrance2event(event, occurrence, occurrence_uid), issue_id)
+		except Exception as err:
+			log.warning("Couldn't expand the recurring event (uid=%s): %s",
+				uid, err)
+			continue
+		result.update(occurrence_events)
+		if expanded is not None:
+			expanded.add(uid)
+		if next_occurrence and (next_start is None or next_occurrence < next_start):
+			next_start = next_occurrence
+	return result, next_start
 
-def process(users_events, users_entries, settings):
-	'''Processes events from an iCal feed.'''
+def process(session, users_events, users_entries, settings, feed_uids=None):
+	'''Processes events from an iCal feed, doing the planned writes.
+	If the UIDs of all events in the feed are given, the entries of events
+	that was removed from it are deleted as well.'''
+	summary, writes = plan(session, users_events, users_entries, settings,
+		feed_uids)
+	# Do the writes concurrently, collecting the results afterwards.
+	results = pool.run(
+		lambda write_args: write(session, users_entries, settings, *write_args),
+		writes, settings['write_workers'])
+	for (uid, event, issue_id, destiny), exp in zip(writes, results):
+		if exp is None and event is None:
+			summary['orphans'].append(users_entries[uid])
+		elif exp is None:
+			summary[destiny] += 1
+		else:
+			summary['errors'].append({
+				'uid': uid,
+				'event': event,
+				'issue_id': issue_id,
+				'destiny': destiny,
+				'exp': exp
+			})
+	return summary
+
+def plan(session, users_events, users_entries, settings, feed_uids=None):
+	'''Plans the writes needed, to bring the entries in line with the events,
+	without doing them. Returns the summary (counting the skipped events) and
+	the writes as a list of (uid, event, issue_id, destiny), where the event is
+	None for the entries of events removed from the feed.'''
 	summary = {
 		destinator.DESTINY_SKIP: 0,
 		destinator.DESTINY_CREATE: 0,
 		destinator.DESTINY_UPDATE: 0,
 		destinator.DESTINY_DELETE: 0,
 		'recurring_events': 0,
+		'orphans': [],
+		'due': None,
 		'errors': []
 	}
 	matching_events = {}
 	# Loop through all iCal events from the ical feed.
 	for uid, event in users_events.items():
-		event_summary = unicode(event.get('SUMMARY'))
-		# Match the pattern with the summary.
-		match = settings["pattern"].match(event_summary)
-		if match:
-			issue_id = match.group('issue_id')
-			matching_events[uid] = event, issue_id
+		# The summary was routed to an issue, when it was parsed.
+		if event.issue_id is not None:
+			matching_events[uid] = event, event.issue_id
 			# We've got a relevant event
 			log.debug("An event '%s' (%s) matches issue id #%s",
-				event_summary, uid, issue_id)
+				event.summary, uid, event.issue_id)
 	original_matching_events_count = len(matching_events)
-	# Check for recurring events (currently not supported).
+	# Expand the recurring events into their occurrences until now.
 	recurring_events = find_recurring_events(matching_events)
 	summary["recurring_events"] = recurring_events
-	# matching_events.update(expand_recurrances(recurring_events))
+	overrides = dict([(uid, event) for uid, event in users_events.items()
+		if event.recurrence_id])
+	start = settings['ignore_events_older_than'] or None
+	expanded = set()
+	recurrances, next_start = expand_recurrances(recurring_events, overrides,
+		settings, start, expanded=expanded)
+	for uid in recurring_events.keys():
+		del matching_events[uid]
+	matching_events.update(recurrances)
+	# Until the next occurrence starts, no more will be expanded.
+	due = destinator.next_due(matching_events, settings)
+	if next_start and (due is None or next_start < due):
+		due = next_start
+	summary['due'] = due
 	log.info("Found %u events in the iCal feed matching the pattern," \
 		" which was expanded to %u when expading rrules.",
 		original_matching_events_count,
 		len(matching_events) )
 
+	state_store = settings.get('state_store')
+	if entries.fetch_since(settings):
+		find_older_entries(session, matching_events, users_entries, settings)
+	fingerprints = None
+	if state_store:
+		fingerprints = state_store.get_fingerprints(session.user.id)
+	writes = []
 	for uid, (event, issue_id) in matching_events.items():
-		destiny = destinator.determine_event_destiny(
-			event, issue_id, users_entries, settings)
+		with metrics.timed('destiny', session.user.login):
+			destiny = destinator.determine_event_destiny(
+				event, issue_id, users_entries, settings, fingerprints)
 		log.debug("Event (uid=%s) should be %s.", uid, destiny)
+		if destiny == destinator.DESTINY_SKIP:
+			if state_store and uid in users_entries:
+				# Remember the event, to skip it faster next time.
+				entry = users_entries[uid]
+				event_fingerprint = state.fingerprint(event, issue_id, entry,
+					settings['custom_time_entry_field_id'])
+				if event_fingerprint != fingerprints.get(int(entry.id)):
+					state_store.put_fingerprint(int(entry.id), event_fingerprint)
+			summary[destiny] += 1
+		else:
+			writes.append((uid, event, issue_id, destiny))
+	# Delete the entries of removed events, through the same writes.
+	if feed_uids is not None:
+		# Occurrences of expanded events are only kept, if they still occur.
+		occurrence_uids = set(recurrances.keys()) | set(overrides.keys())
+		expanded_events = dict([(uid, recurring_events[uid][0])
+			for uid in expanded])
+		for uid in destinator.find_orphans(users_entries, feed_uids, settings,
+			expanded_events, occurrence_uids, start):
+			entry = users_entries[uid]
+			log.debug("Entry (id=%s) of a removed event (uid=%s) should be %s.",
+				entry.id, uid, destinator.DESTINY_DELETE)
+			writes.append((uid, None, entry.issue.id, destinator.DESTINY_DELETE))
+	return summary, writes
+
+def find_older_entries(session, matching_events, users_entries, settings):
+	'''Finds the entries of the events about to be created, which are older than
+	the entries fetched (as the event has been moved since), adding them to the
+	known entries. Otherwise the events would be created again.'''
+	uids = [uid for uid, (event, issue_id) in matching_events.items()
+		if uid not in users_entries and isinstance(event.start, datetime) and
+		isinstance(event.end, datetime) and event.end <= clock.now() and
+		event.start >= settings['ignore_events_older_than']]
+	if not uids:
+		return
+	custom_field_id = settings['custom_time_entry_field_id']
+	found = entries.fetch_by_uids(session, settings, uids)
+	for entry in found:
+		uid = entry.get_custom_field_value(custom_field_id)
+		if uid in users_entries:
+			log.error('Found two time entries (id=%s and id=%s) referencing the '
+				'same iCal uid=%s!', entry.id, users_entries[uid].id, uid)
+			continue
+		log.debug("Found an older entry (id=%s) of a moved event (uid=%s).",
+			entry.id, uid)
+		users_entries[uid] = entry
+	state_store = settings.get('state_store')
+	if state_store and found:
+		state_store.put_entries(session.user.id, [state.entry2row(entry,
+			custom_field_id) for entry in found])
+
+def write(session, users_entries, settings, uid, event, issue_id, destiny):
+	'''Creates, updates or deletes the entry of an event, according to its
+	destiny, recording it in the journal if any. Returns the exception if one
+	was raised, None otherwise.'''
+	state_store = settings.get('state_store')
+	journal = settings.get('journal')
+	if journal:
+		known_entry = users_entries.get(uid)
+		record_id = journal.intend(session.user, uid, destiny,
+			known_entry and known_entry.id)
+	entry = None
+	with metrics.timed('write_' + destiny, session.user.login):
 		try:
 			if destiny == destinator.DESTINY_CREATE:
-				entry = entries.create(event, issue_id, users_entries, settings)
+				entry = entries.create(session, event, issue_id,
+					users_entries, settings)
 				if entry == None or not entry.id:
 					log.error("Error occurred when creating entry.")
+				elif state_store:
+					state.record(state_store, session.user, entry, settings,
+						event, issue_id)
 			elif destiny == destinator.DESTINY_UPDATE:
-				log.error("Event should be updated, but its not implemented!")
-				entry = entries.update(event, issue_id, users_entries, settings)
+				entry = entries.update(session, event, issue_id,
+					users_entries, settings)
 				if entry == None or not entry.id:
 					log.error("Error occurred when updating entry.")
+				elif state_store:
+					state.record(state_store, session.user, entry, settings,
+						event, issue_id)
 			elif destiny == destinator.DESTINY_DELETE:
-				entries.delete(event, users_entries)
-			elif destiny != destinator.DESTINY_SKIP:
+				entries.delete(uid, users_entries)
+				if state_store:
+					state_store.forget_entry(users_entries[uid].id)
+			else:
 				log.error("Unsupported destiny!")
-			summary[destiny] += 1
+			if journal:
+				journal.outcome(record_id, destiny == destinator.DESTINY_DELETE or
+					bool(entry and entry.id), entry and entry.id)
+			return None
 		except Exception as exp:
 			log.exception("Error when entry was appempted %s: %s", destiny, exp)
-			summary['errors'].append({
-				'uid': uid,
-				'event': event,
-				'issue_id': issue_id,
-				'destiny': destiny,
-				'exp': exp
-			})
-	return summary
+			if isinstance(exp, ResourceNotFound) and state_store and \
+				uid in users_entries:
+				# The entry was removed from Redmine, since the store was refreshed.
+				state_store.forget_entry(users_entries[uid].id)
+			if journal:
+				journal.outcome(record_id, False)
+			return exp
@@ -0,0 +1,111 @@
+'''Shares the iCal feeds of a run between users, as many users point at the
+same (shared) calendar, so every distinct feed is fetched and parsed once.'''
+import threading, urlparse
+from ical2redmine.logger import LOG as log
+from ical2redmine import events, metrics
+
+# The ports implied by the schemes, dropped when normalizing URLs.
+DEFAULT_PORTS = { 'http': 80, 'https': 443 }
+
+def normalize(url):
+	'''Normalizes a URL, so URLs differing only in the case of the scheme and
+	host, a default port, an empty path or a fragment are the same feed.'''
+	parts = urlparse.urlsplit(url.strip())
+	scheme = parts.scheme.lower()
+	host = (parts.hostname or '').lower()
+	if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+		host = "%s:%u" % (host, parts.port)
+	if parts.username or parts.password:
+		host = "%s@%s" % (parts.netloc.rsplit('@', 1)[0], host)
+	return urlparse.urlunsplit((scheme, host, parts.path or '/', parts.query,
+		''))
+
+class Feed(object):
+	'''What is known of a feed during a run: the hash of its content, the
+	validators it was served with, and the events parsed from it, by the
+	fingerprint of the matcher they were routed by.'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.hash = None
+		self.validators = {}
+		self.parsed = {}
+
+class FeedRegistry(object):
+	'''The feeds of a run, by their normalized URL. A feed is fetched by the
+	first user pointing at it, while any other user waits, and its events are
+	shared with the other users, who must not change them. Feeds with the
+	same content, at different URLs, share their events too.'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.feeds = {}
+		# The events parsed, by the hash of the content and matcher fingerprint.
+		self.contents = {}
+		self.fetches = 0
+		self.hits = 0
+
+	def feed(self, url):
+		'''The feed at a URL, added if it's new to the run.'''
+		key = normalize(url)
+		with self.lock:
+			if key not in self.feeds:
+				self.feeds[key] = Feed()
+			return self.feeds[key]
+
+	def fetch(self, ical_url, settings, cached=None, uids=None):
+		'''Fetches the events of a feed like events.fetch, unless it has been
+		fetched already during the run. The events returned are shared.'''
+		feed = self.feed(ical_url)
+		fingerprint = settings['matcher'].fingerprint
+		with feed.lock:
+			if cached and feed.hash and cached.get('hash') == feed.hash:
+				self.hit('unchanged')
+				log.debug("The feed was fetched already, and hasn't changed since "
+					"the last sync.")
+				return None
+			if fingerprint in feed.parsed:
+				self.hit('shared')
+				log.debug("The feed was fetched already, sharing its events.")
+				result, feed_uids = feed.parsed[fingerprint]
+				if cached is not None:
+					cached.update(feed.validators)
+				if uids is not None:
+					uids.update(feed_uids)
+				return result
+			record = cached if cached is not None else {}
+			feed_uids = set()
+			result = events.fetch(ical_url, settings, record, feed_uids)
+			with self.lock:
+				self.fetches += 1
+			metrics.count('feed_registry', result='fetched')
+			feed.hash = record.get('hash')
+			if result is None:
+				return None
+			feed.validators = dict([(name, record.get(name))
+				for name in ['etag', 'last_modified', 'hash']])
+			feed_uids = frozenset(feed_uids)
+			with self.lock:
+				key = (feed.hash, fingerprint)
+				if key in self.contents:
+					# The same content was fetched from another URL.
+					result, feed_uids = self.contents[key]
+				else:
+					self.contents[key] = (result, feed_uids)
+			feed.parsed[fingerprint] = (result, feed_uids)
+			if uids is not None:
+				uids.update(feed_uids)
+			return result
+
+	def hit(self, kind):
+		'''Counts a feed shared with another user.'''
+		with self.lock:
+			self.hits += 1
+		metrics.count('feed_registry', result=kind)
+
+	def report(self):
+		'''Logs how many feeds were fetched, and how often they were shared.'''
+		if not self.feeds:
+			return
+		log.info("Fetched %u feed(s) for %u distinct URL(s) and %u distinct "
+			"content(s), shared %u time(s).", self.fetches, len(self.feeds),
+			len(set([feed.hash for feed in self.feeds.values() if feed.hash])),
+			self.hits)
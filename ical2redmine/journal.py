@@ -0,0 +1,200 @@
+'''A write-ahead journal of a run, so a run that stopped halfway can be
+resumed where it stopped.'''
+import json, os, threading, time
+from ical2redmine.logger import LOG as log
+try:
+	import fcntl
+except ImportError:
+	# Without it (on Windows), journals aren't locked.
+	fcntl = None
+
+# The records written to the journal, after which it's emptied (when nothing
+# is in flight) by compact.
+COMPACT_RECORDS = 1000
+
+class JournalLocked(Exception):
+	'''Raised when the journal is in use by another process.'''
+
+def acquire(directory, name='journal'):
+	'''Opens a journal in the directory, which no other process is using. As
+	processes syncing side by side (shards) each need their own journal, the
+	first of name.jsonl, name.1.jsonl, ... that isn't locked is used, resuming
+	it if its run was interrupted.'''
+	slot = 0
+	while True:
+		suffix = ".%u" % slot if slot else ''
+		path = os.path.join(directory, "%s%s.jsonl" % (name, suffix))
+		try:
+			return Journal(path)
+		except JournalLocked:
+			log.debug("The journal %s is in use by another process.", path)
+			slot += 1
+
+class Journal(object):
+	'''A file of JSON lines, recording every write before it's attempted
+	(an intent) and after (its outcome), and every user synced (a checkpoint).
+	Every record is flushed to disk before going on. When the run has finished
+	the journal is removed, so if one is found when starting, the run it
+	belongs to was interrupted and is resumed: The users synced by that run
+	are skipped, and the writes without an outcome (which may or may not have
+	been done) are reconciled with Redmine. Every run starts anew in the
+	journal, so the users skipped by a resumed run are synced by the next one,
+	when it's interrupted too. The journal can be shared by the threads
+	processing users. The journal is locked for as long as it's open, so no
+	other process uses it.'''
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.records = 0
+		self.next_id = 1
+		self.started = None
+		# The writes of this run, without an outcome yet.
+		self.pending = set()
+		# What is known of the interrupted run, if resuming.
+		self.synced_users = set()
+		self.completed = set()
+		self.in_flight = {}
+		self.handle = self.lock_file()
+		self.load()
+		# Reading and writing a file needs a seek in between.
+		self.handle.seek(0, os.SEEK_END)
+		self.started = time.time()
+		self.write({'kind': 'started', 'started': self.started})
+
+	def lock_file(self):
+		'''Opens the journal and locks it, raising JournalLocked if another
+		process has locked it.'''
+		while True:
+			handle = open(self.path, 'a+')
+			if fcntl is None:
+				return handle
+			try:
+				fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except IOError:
+				handle.close()
+				raise JournalLocked(self.path)
+			# The process holding the lock may have removed the journal, before
+			# releasing it. Then a new journal is opened instead.
+			try:
+				if os.fstat(handle.fileno()).st_ino == os.stat(self.path).st_ino:
+					return handle
+			except OSError:
+				pass
+			handle.close()
+
+	def load(self):
+		'''Reads the journal of an interrupted run, if any.'''
+		self.handle.seek(0)
+		if not self.handle.read(1):
+			return
+		self.handle.seek(0)
+		intents = {}
+		for line in self.handle:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				# The last line may be torn, when the run stopped writing it.
+				log.warning("Ignoring a broken line at the end of the journal.")
+				break
+			self.records += 1
+			kind = record['kind']
+			if kind == 'started':
+				# Only the users synced by the last run are skipped.
+				self.started = record['started']
+				self.synced_users.clear()
+			elif kind == 'intent':
+				intents[record['id']] = record
+				self.next_id = max(self.next_id, record['id'] + 1)
+			elif kind == 'outcome':
+				intent = intents.pop(record['id'], None)
+				if intent and record['ok']:
+					self.completed.add((intent['user_id'], intent['uid'],
+						intent['destiny']))
+			elif kind == 'synced':
+				self.synced_users.add(record['user_id'])
+				# The writes in flight before, were reconciled when syncing the user.
+				for record_id, intent in intents.items():
+					if intent['user_id'] == record['user_id']:
+						del intents[record_id]
+		for intent in intents.values():
+			self.in_flight.setdefault(intent['user_id'], []).append(intent)
+		log.warning("Resuming the run started %s, which was interrupted after "
+			"syncing %u user(s) with %u write(s) in flight.",
+			time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started or 0)),
+			len(self.synced_users), len(intents))
+
+	def write(self, record):
+		'''Writes a record, making sure it's on disk before returning.'''
+		with self.lock:
+			self.handle.write(json.dumps(record, sort_keys=True,
+				separators=(',', ':')) + '\n')
+			self.handle.flush()
+			os.fsync(self.handle.fileno())
+			self.records += 1
+
+	def intend(self, user, uid, destiny, entry_id=None):
+		'''Records a write about to be attempted, returning its id.'''
+		with self.lock:
+			record_id = self.next_id
+			self.next_id += 1
+			self.pending.add(record_id)
+		self.write({
+			'kind': 'intent',
+			'id': record_id,
+			'user_id': int(user.id),
+			'uid': uid,
+			'destiny': destiny,
+			'entry_id': entry_id and int(entry_id)
+		})
+		return record_id
+
+	def outcome(self, record_id, ok, entry_id=None):
+		'''Records the outcome of a write.'''
+		self.write({
+			'kind': 'outcome',
+			'id': record_id,
+			'ok': ok,
+			'entry_id': entry_id and int(entry_id)
+		})
+		with self.lock:
+			self.pending.discard(record_id)
+
+	def checkpoint(self, user):
+		'''Records that a user has been synced.'''
+		self.write({'kind': 'synced', 'user_id': int(user.id)})
+
+	def synced(self, user):
+		'''Was the user synced by the interrupted run?'''
+		return int(user.id) in self.synced_users
+
+	def done(self, user, uid, destiny):
+		'''Was the write done by the interrupted run?'''
+		return (int(user.id), uid, destiny) in self.completed
+
+	def reconcile(self, user):
+		'''Takes the writes of a user, which were in flight when the run was
+		interrupted.'''
+		with self.lock:
+			return self.in_flight.pop(int(user.id), [])
+
+	def compact(self):
+		'''Empties the journal, when it has grown large and no write is in
+		flight (or left to reconcile, from the interrupted run). Used when
+		running as a daemon, where users are synced again and again.'''
+		with self.lock:
+			if self.records < COMPACT_RECORDS or self.pending or self.in_flight:
+				return
+			# The journal is emptied in place, keeping it locked.
+			self.handle.truncate(0)
+			self.records = 0
+			self.synced_users.clear()
+			self.completed.clear()
+		self.write({'kind': 'started', 'started': self.started})
+
+	def finish(self):
+		'''Removes the journal, once the run has finished. It's removed while
+		still locked, so no other process starts using it meanwhile.'''
+		with self.lock:
+			os.remove(self.path)
+			self.handle.close()
+		log.debug("The run has finished, removed the journal.")
@@ -0,0 +1,145 @@
+'''Records metrics of a run: histograms of how long every stage takes, the
+time spent on every user and counters, which are exported when it's done.'''
+import threading, time, json, os
+from contextlib import contextmanager
+from ical2redmine.logger import LOG as log
+
+# The upper bounds (in seconds) of the histogram buckets.
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+	30.0, 60.0]
+
+LOCK = threading.Lock()
+LOCAL = threading.local()
+STARTED = time.time()
+HISTOGRAMS = {}
+USERS_SECONDS = {}
+COUNTERS = {}
+
+class Histogram(object):
+	'''Counts the observations in cumulative buckets, like Prometheus does.'''
+	def __init__(self):
+		self.counts = [0] * len(BUCKETS)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value):
+		'''Adds an observation.'''
+		for index, bound in enumerate(BUCKETS):
+			if value <= bound:
+				self.counts[index] += 1
+		self.count += 1
+		self.sum += value
+
+def set_user(login):
+	'''Sets the user, that the stages timed by this thread belongs to.'''
+	LOCAL.user = login
+
+def observe(stage, seconds, user=None):
+	'''Records how long a stage took, for the user (or the user of the thread).'''
+	if user is None:
+		user = getattr(LOCAL, 'user', None)
+	with LOCK:
+		if stage not in HISTOGRAMS:
+			HISTOGRAMS[stage] = Histogram()
+		HISTOGRAMS[stage].observe(seconds)
+		if user is not None:
+			key = (user, stage)
+			USERS_SECONDS[key] = USERS_SECONDS.get(key, 0.0) + seconds
+
+@contextmanager
+def timed(stage, user=None):
+	'''Times the stage, running in the with block.'''
+	started = time.time()
+	try:
+		yield
+	finally:
+		observe(stage, time.time() - started, user)
+
+def count(name, value=1, **labels):
+	'''Adds to a counter, labels distinguishes counters of the same name.'''
+	key = (name, tuple(sorted(labels.items())))
+	with LOCK:
+		COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+def reset():
+	'''Forgets all metrics, starting a new run.'''
+	global STARTED
+	with LOCK:
+		STARTED = time.time()
+		HISTOGRAMS.clear()
+		USERS_SECONDS.clear()
+		COUNTERS.clear()
+
+def to_json():
+	'''The metrics, as a JSON serializable dict.'''
+	with LOCK:
+		return {
+			'started': STARTED,
+			'seconds': time.time() - STARTED,
+			'stages': dict([(stage, {
+				'buckets': dict(zip([str(bound) for bound in BUCKETS],
+					histogram.counts)),
+				'count': histogram.count,
+				'sum': histogram.sum
+			}) for stage, histogram in HISTOGRAMS.items()]),
+			'users': dict([(user, dict([(stage, seconds)
+				for (other_user, stage), seconds in USERS_SECONDS.items()
+				if other_user == user]))
+				for user, stage in USERS_SECONDS.keys()]),
+			'counters': [dict(labels, name=name, value=value)
+				for (name, labels), value in sorted(COUNTERS.items())]
+		}
+
+def format_labels(labels):
+	'''Formats the labels of a Prometheus sample.'''
+	if not labels:
+		return ''
+	return '{%s}' % ','.join(['%s="%s"' % (name, unicode(value)
+		.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+		for name, value in labels])
+
+def to_prometheus():
+	'''The metrics, in the Prometheus text exposition format.'''
+	lines = []
+	with LOCK:
+		lines.append("# TYPE ical2redmine_run_started_seconds gauge")
+		lines.append("ical2redmine_run_started_seconds %f" % STARTED)
+		lines.append("# TYPE ical2redmine_run_seconds gauge")
+		lines.append("ical2redmine_run_seconds %f" % (time.time() - STARTED))
+		lines.append("# TYPE ical2redmine_stage_seconds histogram")
+		for stage, histogram in sorted(HISTOGRAMS.items()):
+			for bound, bucket_count in zip(BUCKETS, histogram.counts):
+				lines.append("ical2redmine_stage_seconds_bucket%s %u" % (
+					format_labels([('stage', stage), ('le', bound)]), bucket_count))
+			lines.append("ical2redmine_stage_seconds_bucket%s %u" % (
+				format_labels([('stage', stage), ('le', '+Inf')]), histogram.count))
+			lines.append("ical2redmine_stage_seconds_sum%s %f" % (
+				format_labels([('stage', stage)]), histogram.sum))
+			lines.append("ical2redmine_stage_seconds_count%s %u" % (
+				format_labels([('stage', stage)]), histogram.count))
+		lines.append("# TYPE ical2redmine_user_stage_seconds_total counter")
+		for (user, stage), seconds in sorted(USERS_SECONDS.items()):
+			lines.append("ical2redmine_user_stage_seconds_total%s %f" % (
+				format_labels([('user', user), ('stage', stage)]), seconds))
+		typed = set()
+		for (name, labels), value in sorted(COUNTERS.items()):
+			if name not in typed:
+				lines.append("# TYPE ical2redmine_%s_total counter" % name)
+				typed.add(name)
+			lines.append("ical2redmine_%s_total%s %s" % (name,
+				format_labels(labels), value))
+	return u"\n".join(lines) + u"\n"
+
+def write(path):
+	'''Writes the metrics to a file, as JSON if it ends with .json, otherwise
+	as a Prometheus textfile. The file is replaced atomically, so a collector
+	never reads half of it.'''
+	if path.endswith('.json'):
+		content = json.dumps(to_json(), sort_keys=True)
+	else:
+		content = to_prometheus().encode('utf-8')
+	temporary_path = "%s.%u.tmp" % (path, os.getpid())
+	with open(temporary_path, 'w') as metrics_handle:
+		metrics_handle.write(content)
+	os.rename(temporary_path, path)
+	log.debug("Wrote the metrics to '%s'.", path)
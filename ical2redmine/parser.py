@@ -0,0 +1,103 @@
+'''Parses an iCal feed incrementally, one VEVENT at a time.'''
+import re
+
+# Escaped characters in iCal text values (RFC 5545, section 3.3.11).
+ESCAPED_PATTERN = re.compile(r'\\([\\;,nN])')
+ESCAPED_VALUES = { '\\': '\\', ';': ';', ',': ',', 'n': '\n', 'N': '\n' }
+
+def iter_raw_lines(chunks):
+	'''Yields the lines from chunks of bytes, without their line endings.'''
+	buffered = ''
+	for chunk in chunks:
+		buffered += chunk
+		lines = buffered.split('\n')
+		buffered = lines.pop()
+		for line in lines:
+			yield line.rstrip('\r')
+	if buffered:
+		yield buffered.rstrip('\r')
+
+def iter_lines(chunks):
+	'''Yields the unfolded content lines, from chunks of bytes.'''
+	current = None
+	for line in iter_raw_lines(chunks):
+		if line[:1] in (' ', '\t') and current is not None:
+			# A folded line continues the previous line.
+			current += line[1:]
+			continue
+		if current is not None:
+			yield current.decode('utf-8', 'replace')
+		current = line
+	if current is not None:
+		yield current.decode('utf-8', 'replace')
+
+def split_line(line):
+	'''Splits a content line into its name (without parameters) and value.'''
+	quoted = False
+	for index, character in enumerate(line):
+		if character == '"':
+			quoted = not quoted
+		elif character == ':' and not quoted:
+			name = line[:index].split(';', 1)[0]
+			return name.upper(), line[index+1:]
+	return line.upper(), u''
+
+def unescape(value):
+	'''Unescapes an iCal text value.'''
+	return ESCAPED_PATTERN.sub(lambda match: ESCAPED_VALUES[match.group(1)],
+		value)
+
+def iter_events(lines, properties=None, pattern=None, uids=None,
+	timezones=None):
+	'''Yields the content lines of every VEVENT, as a list, along with what the
+	pattern's match method returned for its SUMMARY (None without a pattern).
+	If a pattern is given, events with a SUMMARY that doesn't match are skipped,
+	unless they override an occurrence of a recurring event (RECURRENCE-ID).
+	Properties of the calendar itself are put into the properties dict, the
+	UID of every event (skipped or not) is added to the uids set, and the
+	content lines of every VTIMEZONE are put into the timezones dict by TZID.'''
+	depth = 0
+	event_lines = None
+	timezone_lines = None
+	tzid = None
+	skipping = False
+	overriding = False
+	match = None
+	for line in lines:
+		name, value = split_line(line)
+		if name == 'BEGIN':
+			depth += 1
+			if depth == 2 and value.upper() == 'VEVENT':
+				event_lines = []
+				skipping = False
+				overriding = False
+				match = None
+			elif depth == 2 and value.upper() == 'VTIMEZONE' and \
+				timezones is not None:
+				timezone_lines = []
+				tzid = None
+		if timezone_lines is not None:
+			timezone_lines.append(line)
+			if depth == 2 and name == 'TZID':
+				tzid = value
+		elif event_lines is not None:
+			event_lines.append(line)
+			if depth == 2 and name == 'SUMMARY' and pattern is not None:
+				match = pattern.match(unescape(value))
+				skipping = not match
+			elif depth == 2 and name == 'RECURRENCE-ID':
+				overriding = True
+			elif depth == 2 and name == 'UID' and uids is not None:
+				uids.add(unescape(value))
+		elif depth == 1 and properties is not None and name != 'BEGIN':
+			properties[name] = unescape(value)
+		if name == 'END':
+			depth -= 1
+			if depth == 1 and timezone_lines is not None:
+				if tzid is not None:
+					timezones[tzid] = timezone_lines
+				timezone_lines = None
+			if depth == 1 and event_lines is not None:
+				if not skipping or overriding:
+					yield event_lines, match
+				event_lines = None
@@ -0,0 +1,187 @@
+'''Plans the writes of a sync in a file of JSON lines, to be reviewed and
+applied later.'''
+import json, threading, time
+from datetime import datetime
+from ical2redmine.logger import LOG as log
+from ical2redmine import entries, destinator, redmine, state, pool, metrics
+
+# The values of an entry, which are written when creating or updating it.
+ENTRY_FIELDS = ['issue_id', 'spent_on', 'hours', 'comments']
+# The values of an entry, which are only written when routed to.
+OPTIONAL_ENTRY_FIELDS = ['activity_id']
+
+class PlanWriter(object):
+	'''Writes the planned operations of every user to a file, one per line,
+	after a first line describing the plan. It can be shared by the threads
+	processing users.'''
+	def __init__(self, path, settings):
+		log.debug("Writing the plan to '%s'.", path)
+		self.lock = threading.Lock()
+		self.handle = open(path, 'w')
+		self.count = 0
+		self.write_line({
+			'redmine_url': settings['redmine_url'],
+			'planned_on': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+		})
+
+	def write_line(self, record):
+		'''Writes a single line of compact JSON.'''
+		self.handle.write(json.dumps(record, sort_keys=True,
+			separators=(',', ':')) + '\n')
+
+	def add(self, user, writes, users_entries, settings):
+		'''Adds the planned writes of a user, as returned by events.plan.'''
+		operations = [operation(user, users_entries, settings, *write_args)
+			for write_args in writes]
+		with self.lock:
+			for record in operations:
+				self.write_line(record)
+			self.count += len(operations)
+			self.handle.flush()
+
+	def close(self):
+		'''Closes the file, once every user has been planned.'''
+		self.handle.close()
+		log.info("Planned %u write(s) in total.", self.count)
+
+def operation(user, users_entries, settings, uid, event, issue_id, destiny):
+	'''Maps a planned write into an operation, which can be serialized.'''
+	result = {
+		'user_id': int(user.id),
+		'login': user.login,
+		'uid': uid,
+		'destiny': destiny
+	}
+	if uid in users_entries:
+		result['entry_id'] = int(users_entries[uid].id)
+	if destiny != destinator.DESTINY_DELETE:
+		entry = entries.event2entry(event, issue_id, users_entries, settings)
+		for field in ENTRY_FIELDS:
+			result[field] = entry.attributes.get(field)
+		for field in OPTIONAL_ENTRY_FIELDS:
+			if entry.attributes.get(field) is not None:
+				result[field] = entry.attributes[field]
+	if event is not None:
+		# Helps whoever reviews the plan.
+		result['summary'] = event.summary
+		result['start'] = event.start.isoformat()
+	return result
+
+def read(path, settings):
+	'''Reads the operations of a plan, grouped by user id.'''
+	log.debug("Reading the plan from '%s'.", path)
+	operations = {}
+	with open(path, 'r') as plan_handle:
+		header = json.loads(plan_handle.readline())
+		if header.get('redmine_url') != settings['redmine_url']:
+			raise ValueError("The plan was made for %s, not %s." % (
+				header.get('redmine_url'), settings['redmine_url']))
+		log.info("Read a plan made on %s.", header.get('planned_on'))
+		for line in plan_handle:
+			if line.strip():
+				record = json.loads(line)
+				operations.setdefault(record['user_id'], []).append(record)
+	return operations
+
+def apply(path, settings):
+	'''Applies a plan, doing the writes of settings['workers'] users at a time.
+	Returns the number of writes done and the number of writes failed.'''
+	operations = read(path, settings)
+	results = pool.run(lambda user_operations: apply_user(user_operations,
+		settings), operations.values(), settings['workers'])
+	done = sum([user_done for user_done, user_failed in results])
+	failed = sum([user_failed for user_done, user_failed in results])
+	return done, failed
+
+def apply_user(user_operations, settings):
+	'''Applies the operations of a single user, returning the number of writes
+	done and failed. When resuming an interrupted apply, the writes it has done
+	are skipped.'''
+	user = redmine.Users({
+		'id': user_operations[0]['user_id'],
+		'login': user_operations[0]['login']
+	})
+	session = redmine.impersonate_user(user)
+	metrics.set_user(user.login)
+	journal = settings.get('journal')
+	if journal:
+		user_operations = reconcile(session, user_operations, journal, settings)
+	log.info("Applying %u write(s) as Redmine user with login '%s'",
+		len(user_operations), user.login)
+	results = pool.run(lambda record: apply_operation(session, record, settings),
+		user_operations, settings['write_workers'])
+	failed = len([exp for exp in results if exp is not None])
+	return len(results) - failed, failed
+
+def reconcile(session, user_operations, journal, settings):
+	'''Leaves out the operations, which an interrupted apply has done. The
+	creates and deletes which were in flight, are looked up in Redmine.'''
+	user = session.user
+	result = [record for record in user_operations
+		if not journal.done(user, record['uid'], record['destiny'])]
+	in_flight = set([intent['uid'] for intent in journal.reconcile(user)])
+	if not in_flight:
+		return result
+	log.warning("Reconciling %u write(s) in flight when the last apply was "
+		"interrupted, with the entries in Redmine.", len(in_flight))
+	custom_field_id = settings['custom_time_entry_field_id']
+	existing = set([entry.get_custom_field_value(custom_field_id)
+		for entry in entries.fetch(session, settings)])
+	def was_done(record):
+		'''Was the operation in flight and done?'''
+		if record['uid'] not in in_flight:
+			return False
+		if record['destiny'] == destinator.DESTINY_CREATE:
+			return record['uid'] in existing
+		if record['destiny'] == destinator.DESTINY_DELETE:
+			return record['uid'] not in existing
+		return False
+	return [record for record in result if not was_done(record)]
+
+def apply_operation(session, record, settings):
+	'''Creates, updates or deletes an entry as planned, recording it in the
+	journal if any. Returns the exception if one was raised, None otherwise.'''
+	state_store = settings.get('state_store')
+	journal = settings.get('journal')
+	destiny = record['destiny']
+	if journal:
+		record_id = journal.intend(session.user, record['uid'], destiny,
+			record.get('entry_id'))
+	started = time.time()
+	try:
+		entry = session.TimeEntries()
+		if record.get('entry_id'):
+			entry.attributes['id'] = record['entry_id']
+		if destiny == destinator.DESTINY_DELETE:
+			entry.destroy()
+			if state_store:
+				state_store.forget_entry(record['entry_id'])
+			if journal:
+				journal.outcome(record_id, True)
+			return None
+		for field in ENTRY_FIELDS:
+			entry.attributes[field] = record.get(field)
+		for field in OPTIONAL_ENTRY_FIELDS:
+			if record.get(field) is not None:
+				entry.attributes[field] = record[field]
+		entry.attributes['custom_fields'] = [{
+			'id': unicode(settings['custom_time_entry_field_id']),
+			'value': record['uid']
+		}]
+		if not entry.save() or not entry.id:
+			raise ValueError("The entry (uid=%s) wasn't %s." % (record['uid'],
+				destiny))
+		if state_store:
+			state.record(state_store, session.user, entry, settings)
+		if journal:
+			journal.outcome(record_id, True, entry.id)
+		return None
+	except Exception as exp:
+		log.exception("Error when entry (uid=%s) was attempted %s: %s",
+			record['uid'], destiny, exp)
+		if journal:
+			journal.outcome(record_id, False)
+		return exp
+	finally:
+		metrics.observe('write_' + destiny, time.time() - started,
+			session.user.login)
@@ -0,0 +1,49 @@
+'''A small pool of worker threads, used to do work concurrently.'''
+import sys, threading, Queue
+from ical2redmine.logger import LOG as log
+
+def run(function, items, workers=1):
+	'''Calls the function on all items, using at most workers threads.
+	Returns a list of the results, in the same order as the items.
+	If any call raises, no more items are started and the first exception is
+	re-raised in the calling thread, once the running calls have finished.'''
+	if workers <= 1:
+		return [function(item) for item in items]
+	tasks = Queue.Queue(maxsize=workers)
+	results = {}
+	failures = []
+	def work():
+		'''Takes tasks of the queue, until a None is taken.'''
+		while True:
+			task = tasks.get()
+			if task is None:
+				break
+			index, item = task
+			if failures:
+				# Something went wrong, just drain the queue.
+				continue
+			try:
+				results[index] = function(item)
+			except BaseException:
+				log.debug("A worker failed, stopping the pool.")
+				failures.append(sys.exc_info())
+	threads = []
+	for number in range(workers):
+		thread = threading.Thread(target=work, name="worker-%u" % number)
+		thread.daemon = True
+		thread.start()
+		threads.append(thread)
+	count = 0
+	for index, item in enumerate(items):
+		if failures:
+			break
+		tasks.put((index, item))
+		count += 1
+	for thread in threads:
+		tasks.put(None)
+	for thread in threads:
+		thread.join()
+	if failures:
+		error_type, error, traceback = failures[0]
+		raise error_type, error, traceback
+	return [results[index] for index in range(count)]
@@ -0,0 +1,116 @@
+'''Profiles the processing of users, by CPU time or memory.'''
+import cProfile, pstats, gc, os, re, resource, sys, threading, time
+from ical2redmine.logger import LOG as log
+try:
+	# Only available in Python 3, or Python 2 patched with pytracemalloc.
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+MODES = [ 'cpu', 'mem' ]
+
+UNSAFE_CHARACTERS = re.compile(r'[^\w.@-]')
+
+def peak_memory():
+	'''The peak resident memory of the process so far, in MiB.'''
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports kilobytes, OS X bytes.
+	if sys.platform == 'darwin':
+		return peak / 1024.0 / 1024.0
+	return peak / 1024.0
+
+class Profiler(object):
+	'''Profiles every user processed into files of a directory. In cpu mode a
+	pstats file is written per user. In mem mode the memory is measured at the
+	boundaries of the stages, using tracemalloc snapshots when available and
+	the peak resident memory and number of objects otherwise.'''
+	def __init__(self, mode, directory):
+		self.mode = mode
+		self.directory = os.path.realpath(directory)
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.paths = []
+		self.checkpoints = []
+		if self.mode == 'mem' and tracemalloc:
+			tracemalloc.start()
+		elif self.mode == 'mem':
+			log.warning("No tracemalloc, measuring the peak resident memory and "
+				"the number of objects instead.")
+
+	def path(self, name, extension):
+		'''The path of a file in the directory, named after a user.'''
+		return os.path.join(self.directory, "%s.%s" % (
+			UNSAFE_CHARACTERS.sub('_', name), extension))
+
+	def call(self, name, function, *args):
+		'''Calls the function, profiling it under the name.'''
+		self.local.name = name
+		if self.mode == 'cpu':
+			profile = cProfile.Profile()
+			try:
+				return profile.runcall(function, *args)
+			finally:
+				path = self.path(name, 'pstats')
+				profile.dump_stats(path)
+				with self.lock:
+					self.paths.append(path)
+		self.checkpoint('started')
+		try:
+			return function(*args)
+		finally:
+			self.checkpoint('finished')
+
+	def checkpoint(self, stage):
+		'''Measures the memory at the boundary of a stage, in mem mode.'''
+		if self.mode != 'mem':
+			return
+		name = getattr(self.local, 'name', 'main')
+		if tracemalloc:
+			snapshot = tracemalloc.take_snapshot()
+			path = self.path("%s.%s" % (name, stage.replace(' ', '_')),
+				'snapshot')
+			snapshot.dump(path)
+			current, peak = tracemalloc.get_traced_memory()
+			measured = (current / 1024.0 / 1024.0, peak / 1024.0 / 1024.0)
+		else:
+			measured = (peak_memory(), len(gc.get_objects()))
+		with self.lock:
+			self.checkpoints.append((time.time(), name, stage) + measured)
+
+	def report(self, top=10):
+		'''Writes the checkpoints (in mem mode), and prints the top of the
+		profiles.'''
+		if self.mode == 'cpu':
+			if not self.paths:
+				return
+			print "Top %u functions by cumulative time, of %u user(s):" % (top,
+				len(self.paths))
+			stats = pstats.Stats(*self.paths)
+			stats.sort_stats('cumulative').print_stats(top)
+			print "The profiles are in %s" % self.directory
+			return
+		if tracemalloc:
+			header = "%-24s %-20s %14s %14s" % ('user', 'stage', 'traced (MiB)',
+				'peak (MiB)')
+			line_format = "%-24s %-20s %14.1f %14.1f"
+		else:
+			header = "%-24s %-20s %14s %14s" % ('user', 'stage', 'peak (MiB)',
+				'objects')
+			line_format = "%-24s %-20s %14.1f %14u"
+		lines = [header] + [line_format % checkpoint[1:]
+			for checkpoint in sorted(self.checkpoints)]
+		with open(os.path.join(self.directory, 'memory.txt'), 'w') as handle:
+			handle.write("\n".join(lines) + "\n")
+		print "Top %u stage boundaries by memory:" % top
+		print header
+		for checkpoint in sorted(self.checkpoints, key=lambda checkpoint:
+			checkpoint[3], reverse=True)[:top]:
+			print line_format % checkpoint[1:]
+		if tracemalloc and self.checkpoints:
+			print "Top %u allocations at the end:" % top
+			for statistic in tracemalloc.take_snapshot().statistics(
+				'lineno')[:top]:
+				print statistic
+		print "The measurements are in %s" % self.directory
@@ -1,4 +1,6 @@
 '''Implements all the redmine active resources needed for this tool.'''
+import re
+from ical2redmine import transport
 # We need the pyactiverecord module.
 from pyactiveresource.activeresource import ActiveResource
 #from pyactiveresource import formats
@@ -9,11 +11,34 @@ class RedmineActiveResource(ActiveResource):
 		'''Get the value of a custom field on the resource.'''
 		if "custom_fields" in self.to_dict().keys():
 			for field in self.custom_fields:
-				#print type(field.attributes)
-				if int(field.id) == int(custom_field_id):
+				# Entries mapped from events, has their fields as plain dicts.
+				if isinstance(field, dict):
+					if int(field['id']) == int(custom_field_id):
+						return field['value']
+				elif int(field.id) == int(custom_field_id):
 					return field.value
 			return None
 
+# The largest page of resources Redmine will return.
+PAGE_SIZE = 100
+
+# Redmine puts the total_count as an attribute on the root of the listing.
+TOTAL_COUNT_PATTERN = re.compile(r'total_count\W{1,3}(\d+)')
+
+def count(resource, **query):
+	'''Counts the resources matching a query, fetching only a single one.
+	Returns None if Redmine didn't include a total_count in its response.'''
+	query['limit'] = 1
+	query.pop('offset', None)
+	path = resource._collection_path(None, query)
+	# The formatted connection.get drops the attributes of the root element.
+	response = resource.connection._open('GET', path, resource.headers)
+	total_count = TOTAL_COUNT_PATTERN.search(response.body)
+	if total_count:
+		return int(total_count.group(1))
+	else:
+		return None
+
 class TimeEntries(RedmineActiveResource):
 	'''A time entity's active resource'''
 	_singular = 'time_entry'
@@ -35,16 +60,38 @@ class CustomFields(RedmineActiveResource):
 	'''A custom field's active resource'''
 
 def setup(redmine_url, api_key):
-	'''Sets the url and api_key used when communicating with the Redmine API.'''
+	'''Sets the url and api_key used when communicating with the Redmine API.
+	All resources share a connection, using the pooled transport.'''
 	ActiveResource.__metaclass__.set_site(RedmineActiveResource, redmine_url)
 	ActiveResource.__metaclass__.set_user(RedmineActiveResource, api_key)
+	RedmineActiveResource._connection = transport.PooledConnection(
+		RedmineActiveResource.site, RedmineActiveResource.user,
+		RedmineActiveResource.password, RedmineActiveResource.timeout,
+		RedmineActiveResource.format)
+
+def bind(resource, headers):
+	'''Derives a resource class with its own headers.'''
+	return type(resource)(resource.__name__, (resource,), {
+		'__module__': resource.__module__,
+		'_singular': resource._singular,
+		'_plural': resource._plural,
+		'_headers': headers
+	})
+
+class Session(object):
+	'''The Redmine resources, as seen by a single (impersonated) user.
+	As every session has its own resource classes and headers (sent along with
+	every request on the shared connection), it's safe to use sessions of
+	different users in parallel.'''
+	def __init__(self, user=None):
+		self.user = user
+		headers = {}
+		if user:
+			headers['X-Redmine-Switch-User'] = user.login
+		self.TimeEntries = bind(TimeEntries, headers)
+		self.Users = bind(Users, headers)
+		self.CustomFields = bind(CustomFields, headers)
 
 def impersonate_user(user):
-	'''Call this method, just before calling save or update to impersonate.'''
-	if user:
-		headers = {
-			'X-Redmine-Switch-User': user.login
-		}
-	else:
-		headers = None
-	ActiveResource.__metaclass__.set_headers(RedmineActiveResource, headers)
\ No newline at end of file
+	'''Creates a session, in which saves and updates impersonates the user.'''
+	return Session(user)
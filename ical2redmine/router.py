@@ -0,0 +1,147 @@
+'''Routes events to an issue and an activity, by patterns matching the summary
+of the events. Every route applies to all users, or only to some users or
+calendars, and the routes of a user are combined into a single regular
+expression, so every summary is matched once.'''
+import re, sre_parse, sre_constants, json, threading
+
+# The named groups (and references to them) of a pattern.
+GROUP_PATTERN = re.compile(r'\(\?P([<=])(\w+)')
+
+# Patterns with these can't be combined, as the groups are numbered anew.
+COMBINATION_BREAKERS = [ sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS ]
+
+class Route(object):
+	'''A pattern with a named group called issue_id, and optionally one called
+	activity_id. The activity_id can be given instead, for all events matching
+	the pattern. If users (logins) or calendars (iCal URLs) are given, the
+	route only applies to these.'''
+	def __init__(self, pattern, activity_id=None, users=None, calendars=None):
+		self.pattern = pattern
+		self.regex = re.compile(pattern)
+		assert 'issue_id' in self.regex.groupindex, "The pattern '%s', " \
+			"must have a named group called 'issue_id', please visit " \
+			"http://docs.python.org/2/library/re.html#regular-expression-syntax " \
+			"for more information on how to define a regular expression pattern." \
+			% pattern
+		self.activity_id = activity_id
+		self.users = users
+		self.calendars = calendars
+		parsed = sre_parse.parse(pattern)
+		self.literal = required_literal(parsed)
+		# Patterns with flags or numbered back references can't be combined.
+		self.combinable = not self.regex.flags and not [op
+			for op, av in walk(parsed) if op in COMBINATION_BREAKERS]
+
+	def applies(self, login, ical_url):
+		'''Does the route apply to the user and calendar?'''
+		if self.users is not None and login not in self.users:
+			return False
+		if self.calendars is not None and ical_url not in self.calendars:
+			return False
+		return True
+
+	def key(self):
+		'''The values of the route, which decide where events are routed.'''
+		return [self.pattern, self.activity_id]
+
+def walk(items):
+	'''Yields every (opcode, argument) of a parsed pattern, recursively.'''
+	for op, av in items:
+		yield op, av
+		for value in (av if isinstance(av, (tuple, list)) else [av]):
+			nested = value if isinstance(value, list) else [value]
+			for subpattern in nested:
+				if isinstance(subpattern, sre_parse.SubPattern):
+					for item in walk(subpattern):
+						yield item
+
+def required_literal(parsed):
+	'''The longest text, which every match of a parsed pattern must contain.
+	Empty if there's none, or the pattern ignores case.'''
+	if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+		return u''
+	runs = [[]]
+	def visit(items):
+		'''Adds the literal characters to the current run, any other opcode
+		starts a new one. Groups (which must match) are visited too.'''
+		for op, av in items:
+			if op == sre_constants.LITERAL:
+				runs[-1].append(unichr(av))
+			elif op == sre_constants.SUBPATTERN:
+				visit(av[-1])
+			else:
+				runs.append([])
+	visit(parsed)
+	return max([u''.join(run) for run in runs], key=len)
+
+def rename_groups(pattern, prefix):
+	'''Prefixes the named groups of a pattern, so it can be combined.'''
+	return GROUP_PATTERN.sub(lambda match: "(?P%s%s%s" % (match.group(1),
+		prefix, match.group(2)), pattern)
+
+class Matcher(object):
+	'''Matches summaries against the routes of a user, in order. The first
+	route that matches decides the issue and activity.'''
+	def __init__(self, routes):
+		self.routes = routes
+		self.fingerprint = json.dumps([route.key() for route in routes])
+		# Only summaries containing a literal of some route can match, unless a
+		# route has none.
+		literals = [route.literal for route in routes]
+		self.literals = sorted(set(literals)) if all(literals) else None
+		if all([route.combinable for route in routes]):
+			self.regex = re.compile(u"|".join([u"(?P<route%u>%s)" % (index,
+				rename_groups(route.pattern, "route%u_" % index))
+				for index, route in enumerate(routes)]))
+		else:
+			self.regex = None
+
+	def match(self, summary):
+		'''Routes a summary, returning (issue_id, activity_id) or None if no
+		route matches.'''
+		if self.literals is not None:
+			for literal in self.literals:
+				if literal in summary:
+					break
+			else:
+				return None
+		if self.regex is None:
+			for route in self.routes:
+				match = route.regex.match(summary)
+				if match:
+					return self.route(route, match, '')
+			return None
+		match = self.regex.match(summary)
+		if not match:
+			return None
+		# The group of the route is the outermost, so it's closed last.
+		index = int(match.lastgroup[len('route'):])
+		return self.route(self.routes[index], match, "route%u_" % index)
+
+	def route(self, route, match, prefix):
+		'''The issue and activity of a match of a route.'''
+		groups = match.groupdict()
+		activity_id = groups.get(prefix + 'activity_id') or route.activity_id
+		return groups[prefix + 'issue_id'], activity_id
+
+class Router(object):
+	'''Holds the routes of the settings: the ones in settings['routes'] first,
+	followed by settings['pattern'] which applies to everyone. The matchers of
+	users are cached, as many users share the same routes.'''
+	def __init__(self, settings):
+		self.routes = [Route(route['pattern'], route.get('activity_id'),
+			route.get('users'), route.get('calendars'))
+			for route in settings.get('routes', [])]
+		self.routes.append(Route(settings['pattern']))
+		self.lock = threading.Lock()
+		self.matchers = {}
+
+	def matcher(self, login=None, ical_url=None):
+		'''The matcher of the routes, which applies to a user and calendar.'''
+		indices = tuple([index for index, route in enumerate(self.routes)
+			if route.applies(login, ical_url)])
+		with self.lock:
+			if indices not in self.matchers:
+				self.matchers[indices] = Matcher([self.routes[index]
+					for index in indices])
+			return self.matchers[indices]
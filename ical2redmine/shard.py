@@ -0,0 +1,159 @@
+'''Splits the users between several processes, possibly on several hosts, so
+every user is synced by one of them only.'''
+import hashlib, os, socket, threading, time, uuid
+from ical2redmine.logger import LOG as log
+
+SCHEMA = [
+	"CREATE TABLE IF NOT EXISTS workers ("
+		"worker_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)",
+	"CREATE TABLE IF NOT EXISTS leases ("
+		"user_id INTEGER PRIMARY KEY, worker_id TEXT NOT NULL, "
+		"expires REAL NOT NULL)"
+]
+
+# The seconds the live workers are known, before they are looked up again.
+WORKERS_REFRESH_SECONDS = 5
+
+def user_hash(key):
+	'''A hash of a user (or a user and a worker), which is the same in every
+	process, unlike Python's hash.'''
+	return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:15], 16)
+
+def parse(value):
+	'''Parses a shard given as i/N, where i is in 0 to N-1.'''
+	try:
+		index, count = [int(part) for part in value.split('/')]
+	except ValueError:
+		raise ValueError("The shard '%s' isn't of the form i/N." % value)
+	if count < 1 or not 0 <= index < count:
+		raise ValueError("The shard '%s' should have 0 <= i < N." % value)
+	return index, count
+
+class StaticShard(object):
+	'''The users whose hash of their id, modulo the number of shards, is the
+	index of this shard.'''
+	def __init__(self, index, count):
+		log.info("Syncing the users of shard %u of %u.", index, count)
+		self.index = index
+		self.count = count
+
+	def claim(self, user):
+		'''Does this shard sync the user?'''
+		return user_hash(unicode(user.id)) % self.count == self.index
+
+	def release(self, user):
+		'''Done syncing the user.'''
+		pass
+
+	def close(self):
+		'''Done syncing users.'''
+		pass
+
+class LeaseShard(object):
+	'''A worker among the workers sharing a SQLite store, which every worker
+	sends a heartbeat to. Every user is owned by one of the live workers, by
+	rendezvous hashing, so when a worker stops (or its heartbeat expires) only
+	its users are spread over the other workers. A user is leased by the worker
+	syncing it, so even while workers disagree on who's alive, two of them
+	never sync the same user at the same time.'''
+	def __init__(self, path, lease_seconds):
+		import sqlite3
+		log.debug("Opening the shard store '%s'.", path)
+		self.worker_id = "%s:%u:%s" % (socket.gethostname(), os.getpid(),
+			uuid.uuid4().hex[:8])
+		self.lease_seconds = lease_seconds
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, timeout=lease_seconds,
+			check_same_thread=False)
+		for statement in SCHEMA:
+			self.execute(statement)
+		self.workers = []
+		self.workers_refreshed = 0
+		self.stopping = threading.Event()
+		self.heartbeat()
+		log.info("Syncing users as worker '%s', with %u worker(s) alive.",
+			self.worker_id, len(self.live_workers()))
+		self.thread = threading.Thread(target=self.beat, name="heartbeat")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def execute(self, statement, parameters=()):
+		'''Executes a single statement, returning the number of rows changed.'''
+		with self.lock:
+			cursor = self.connection.execute(statement, parameters)
+			self.connection.commit()
+			return cursor.rowcount
+
+	def query(self, statement, parameters=()):
+		'''Executes a single query, returning all the rows.'''
+		with self.lock:
+			return self.connection.execute(statement, parameters).fetchall()
+
+	def heartbeat(self):
+		'''Tells the other workers this one is alive, and renews its leases.'''
+		now = time.time()
+		self.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)",
+			(self.worker_id, now))
+		self.execute("UPDATE leases SET expires = ? WHERE worker_id = ?",
+			(now + self.lease_seconds, self.worker_id))
+		# Forget the workers, which has been gone for a while.
+		self.execute("DELETE FROM workers WHERE heartbeat < ?",
+			(now - 10 * self.lease_seconds,))
+
+	def beat(self):
+		'''Sends heartbeats, until closed.'''
+		while not self.stopping.wait(self.lease_seconds / 3.0):
+			try:
+				self.heartbeat()
+			except Exception as err:
+				log.error("Couldn't send a heartbeat to the shard store: %s", err)
+
+	def live_workers(self):
+		'''The ids of the workers, whose heartbeat hasn't expired.'''
+		now = time.time()
+		if self.workers_refreshed + WORKERS_REFRESH_SECONDS <= now:
+			rows = self.query("SELECT worker_id FROM workers WHERE heartbeat >= ?",
+				(now - self.lease_seconds,))
+			workers = sorted([row[0] for row in rows])
+			if workers != self.workers:
+				log.info("The users are shared by %u worker(s).", len(workers))
+			self.workers = workers
+			self.workers_refreshed = now
+		return self.workers
+
+	def owner(self, user):
+		'''The live worker, which owns the user.'''
+		return max(self.live_workers() or [self.worker_id], key=lambda worker_id:
+			user_hash(u"%s/%s" % (worker_id, user.id)))
+
+	def claim(self, user):
+		'''Leases the user, if this worker owns it and it isn't leased by any
+		other worker. Returns True if the user was leased.'''
+		if self.owner(user) != self.worker_id:
+			return False
+		now = time.time()
+		with self.lock:
+			leased = self.connection.execute("INSERT OR IGNORE INTO leases "
+				"VALUES (?, ?, ?)", (user.id, self.worker_id,
+				now + self.lease_seconds)).rowcount or \
+				self.connection.execute("UPDATE leases SET worker_id = ?, "
+				"expires = ? WHERE user_id = ? AND (worker_id = ? OR expires < ?)",
+				(self.worker_id, now + self.lease_seconds, user.id, self.worker_id,
+				now)).rowcount
+			self.connection.commit()
+		if not leased:
+			log.info("The user '%s' is synced by another worker.", user.login)
+		return bool(leased)
+
+	def release(self, user):
+		'''Releases the lease of the user, once synced.'''
+		self.execute("DELETE FROM leases WHERE user_id = ? AND worker_id = ?",
+			(user.id, self.worker_id))
+
+	def close(self):
+		'''Stops the heartbeats, and leaves the users to the other workers.'''
+		self.stopping.set()
+		self.thread.join()
+		self.execute("DELETE FROM leases WHERE worker_id = ?", (self.worker_id,))
+		self.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+		self.connection.close()
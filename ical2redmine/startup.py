@@ -0,0 +1,59 @@
+'''Times the startup of the tool, broken down into phases and imports.'''
+import __builtin__, sys, time
+from contextlib import contextmanager
+
+STARTED = time.time()
+PHASES = []
+IMPORTS = {}
+# The seconds spent importing nested modules, for every import in progress.
+NESTED = []
+ORIGINAL_IMPORT = __builtin__.__import__
+
+@contextmanager
+def phase(name):
+	'''Times a phase of the startup, running in the with block.'''
+	started = time.time()
+	try:
+		yield
+	finally:
+		PHASES.append((name, time.time() - started))
+
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+	'''Imports like the builtin __import__, timing the imports which loads
+	modules that wasn't loaded already.'''
+	loaded = len(sys.modules)
+	started = time.time()
+	NESTED.append(0.0)
+	try:
+		return ORIGINAL_IMPORT(name, globals, locals, fromlist, level)
+	finally:
+		elapsed = time.time() - started
+		nested = NESTED.pop()
+		if NESTED:
+			NESTED[-1] += elapsed
+		if len(sys.modules) > loaded:
+			if fromlist:
+				name = "%s (%s)" % (name, ", ".join(fromlist))
+			cumulative, own = IMPORTS.get(name, (0.0, 0.0))
+			IMPORTS[name] = (cumulative + elapsed, own + elapsed - nested)
+
+def install():
+	'''Starts timing imports.'''
+	__builtin__.__import__ = timed_import
+
+def uninstall():
+	'''Stops timing imports.'''
+	__builtin__.__import__ = ORIGINAL_IMPORT
+
+def report(top=15):
+	'''Prints the time spent on every phase, and the slowest imports.'''
+	uninstall()
+	print "Startup took %.1f ms:" % ((time.time() - STARTED) * 1000)
+	for name, seconds in PHASES:
+		print "  %-40s %8.1f ms" % (name, seconds * 1000)
+	print "Top %u imports by own time (excluding nested imports):" % top
+	print "  %-40s %8s %8s" % ('import', 'own', 'total')
+	for name, (cumulative, own) in sorted(IMPORTS.items(),
+		key=lambda item: item[1][1], reverse=True)[:top]:
+		print "  %-40s %5.1f ms %5.1f ms" % (name[:40], own * 1000,
+			cumulative * 1000)
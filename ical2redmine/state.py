@@ -0,0 +1,198 @@
+'''Keeps a local index of the time entries created by this tool.'''
+import threading, time, hashlib, json
+from datetime import datetime, timedelta
+from ical2redmine.logger import LOG as log
+from ical2redmine import entries
+
+SCHEMA = [
+	"CREATE TABLE IF NOT EXISTS entries ("
+		"entry_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+		"uid TEXT NOT NULL, issue_id TEXT, spent_on TEXT, hours TEXT, "
+		"comments TEXT, activity_id TEXT)",
+	"CREATE INDEX IF NOT EXISTS entries_user_id ON entries (user_id)",
+	"CREATE TABLE IF NOT EXISTS users ("
+		"user_id INTEGER PRIMARY KEY, updated_since TEXT, refreshed_on REAL)",
+	"CREATE TABLE IF NOT EXISTS fingerprints ("
+		"entry_id INTEGER PRIMARY KEY, fingerprint TEXT NOT NULL)",
+	"CREATE TABLE IF NOT EXISTS expansions ("
+		"key TEXT PRIMARY KEY, expansion TEXT NOT NULL)"
+]
+
+ENTRY_FIELDS = "entry_id, uid, issue_id, spent_on, hours, comments, " \
+	"activity_id"
+
+class StateStore(object):
+	'''A SQLite database, storing the last known values of every time entry.
+	The store can be shared by the threads processing users.'''
+	def __init__(self, path):
+		log.debug("Opening the state store '%s'.", path)
+		import sqlite3
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		for statement in SCHEMA:
+			self.execute(statement)
+		columns = [row[1] for row in self.execute("PRAGMA table_info(entries)")]
+		if 'activity_id' not in columns:
+			# Stores made before activities were kept, are refreshed in full.
+			log.info("Adding the activities of entries to the state store.")
+			self.execute("ALTER TABLE entries ADD COLUMN activity_id TEXT")
+			self.execute("DELETE FROM users")
+
+	def execute(self, statement, parameters=()):
+		'''Executes a single statement, returning all the rows.'''
+		return self.executemany(statement, [parameters])
+
+	def executemany(self, statement, parameters):
+		'''Executes a statement with every parameters in one transaction.'''
+		with self.lock:
+			rows = []
+			for values in parameters:
+				rows.extend(self.connection.execute(statement, values).fetchall())
+			self.connection.commit()
+			return rows
+
+	def get_user(self, user_id):
+		'''Gets the date entries were updated since (when last refreshed), and
+		the time of the last full refresh of the user. (None, None) if unknown.'''
+		rows = self.execute("SELECT updated_since, refreshed_on FROM users "
+			"WHERE user_id = ?", (user_id,))
+		return rows[0] if rows else (None, None)
+
+	def put_user(self, user_id, updated_since, refreshed_on):
+		'''Stores when the entries of the user were refreshed.'''
+		self.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?)",
+			(user_id, updated_since, refreshed_on))
+
+	def get_entries(self, user_id):
+		'''Gets the rows of all known entries of a user.'''
+		return self.execute("SELECT %s FROM entries WHERE user_id = ?"
+			% ENTRY_FIELDS, (user_id,))
+
+	def put_entries(self, user_id, rows):
+		'''Stores rows of entries of a user, replacing any known values.'''
+		self.executemany("INSERT OR REPLACE INTO entries (user_id, %s) "
+			"VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % ENTRY_FIELDS,
+			[(user_id,) + tuple(row) for row in rows])
+
+	def forget_entry(self, entry_id):
+		'''Forgets an entry, that no longer exists in Redmine.'''
+		self.execute("DELETE FROM entries WHERE entry_id = ?", (entry_id,))
+		self.execute("DELETE FROM fingerprints WHERE entry_id = ?", (entry_id,))
+
+	def get_fingerprints(self, user_id):
+		'''Gets the fingerprints of the entries of a user, by entry id.'''
+		return dict(self.execute("SELECT fingerprints.entry_id, fingerprint "
+			"FROM fingerprints JOIN entries "
+			"ON fingerprints.entry_id = entries.entry_id "
+			"WHERE user_id = ?", (user_id,)))
+
+	def put_fingerprint(self, entry_id, fingerprint):
+		'''Stores the fingerprint of an entry, None removes it.'''
+		if fingerprint:
+			self.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?)",
+				(entry_id, fingerprint))
+		else:
+			self.execute("DELETE FROM fingerprints WHERE entry_id = ?",
+				(entry_id,))
+
+	def get_expansion(self, key):
+		'''Gets an expansion of a recurring event, None if unknown.'''
+		rows = self.execute("SELECT expansion FROM expansions WHERE key = ?",
+			(key,))
+		return json.loads(rows[0][0]) if rows else None
+
+	def put_expansion(self, key, expansion):
+		'''Stores an expansion of a recurring event.'''
+		self.execute("INSERT OR REPLACE INTO expansions VALUES (?, ?)",
+			(key, json.dumps(expansion)))
+
+	def forget_entries(self, user_id):
+		'''Forgets all entries of a user, before a full refresh.'''
+		self.execute("DELETE FROM entries WHERE user_id = ?", (user_id,))
+
+def entry2row(entry, custom_field_id):
+	'''Maps an entry to a row of the values this tool writes.'''
+	issue_id = entry.attributes.get('issue_id')
+	if issue_id is None and entry.attributes.get('issue') is not None:
+		issue_id = entry.issue.id
+	activity_id = entry.attributes.get('activity_id')
+	if activity_id is None and entry.attributes.get('activity') is not None:
+		activity_id = entry.activity.id
+	return (
+		int(entry.id),
+		entry.get_custom_field_value(custom_field_id),
+		issue_id and unicode(issue_id),
+		entry.attributes.get('spent_on'),
+		entry.attributes.get('hours') and unicode(entry.hours),
+		entry.attributes.get('comments'),
+		activity_id and unicode(activity_id)
+	)
+
+def row2entry(session, row, custom_field_id):
+	'''Maps a row back into an entry, which can be updated or destroyed.'''
+	entry_id, uid, issue_id, spent_on, hours, comments, activity_id = row
+	attributes = {
+		'id': entry_id,
+		'issue': { 'id': issue_id },
+		'spent_on': spent_on,
+		'hours': hours,
+		'comments': comments,
+		'custom_fields': [{ 'id': custom_field_id, 'value': uid }]
+	}
+	if activity_id is not None:
+		attributes['activity'] = { 'id': activity_id }
+	return session.TimeEntries(attributes)
+
+def fingerprint(event, issue_id, entry, custom_field_id):
+	'''Fingerprints an event by its SEQUENCE and LAST-MODIFIED, together with
+	the values of the entry representing it. Returns None if the event has
+	neither property, as changes to it can't be told from the fingerprint.'''
+	if event.sequence is None and event.last_modified is None:
+		return None
+	values = [
+		event.sequence and unicode(event.sequence),
+		event.last_modified,
+		unicode(issue_id)
+	]
+	values.extend(entry2row(entry, custom_field_id)[2:])
+	if event.activity_id is not None:
+		values.append(unicode(event.activity_id))
+	return hashlib.sha1(json.dumps(values)).hexdigest()
+
+def record(store, user, entry, settings, event=None, issue_id=None):
+	'''Records the values just written to an entry, and the fingerprint of the
+	event it was written from, if given.'''
+	custom_field_id = settings['custom_time_entry_field_id']
+	store.put_entries(user.id, [entry2row(entry, custom_field_id)])
+	if event is not None:
+		store.put_fingerprint(int(entry.id),
+			fingerprint(event, issue_id, entry, custom_field_id))
+
+def refresh(store, session, settings, full=False):
+	'''Refreshes the users entries in the store, fetching only the entries that
+	was updated in Redmine since the last refresh, unless it's time for a full
+	refresh (or full is given). Returns all the known entries of the user.'''
+	user = session.user
+	custom_field_id = settings['custom_time_entry_field_id']
+	updated_since, refreshed_on = store.get_user(user.id)
+	now = time.time()
+	full_refresh_age = settings['state_full_refresh_days'] * 24 * 60 * 60
+	# Entries updated on the day before, might have been so in another timezone.
+	next_updated_since = (datetime.utcnow() - timedelta(days=1)).strftime(
+		"%Y-%m-%d")
+	if full or updated_since is None or refreshed_on is None or \
+		refreshed_on + full_refresh_age < now:
+		log.debug("Refreshing all entries of the user.")
+		fetched_entries = entries.fetch(session, settings)
+		store.forget_entries(user.id)
+		refreshed_on = now
+	else:
+		log.debug("Refreshing entries of the user, updated since %s.",
+			updated_since)
+		fetched_entries = entries.fetch(session, settings, updated_since)
+	store.put_entries(user.id, [entry2row(entry, custom_field_id)
+		for entry in fetched_entries])
+	store.put_user(user.id, next_updated_since, refreshed_on)
+	log.debug("Refreshed %u entries from Redmine.", len(fetched_entries))
+	return [row2entry(session, row, custom_field_id)
+		for row in store.get_entries(user.id)]
@@ -1,20 +1,27 @@
 '''This modules sends out emails with summeries.'''
+import threading, time, socket, Queue
 from ical2redmine.logger import LOG as log
-# Import smtplib for the actual sending function
-import smtplib
-# Import the email modules we'll need
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from ical2redmine import destinator, metrics
 
-from ical2redmine import destinator
+# How many times a mail is attempted sent, and the seconds to wait before the
+# first retry (doubling for every retry after it).
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 5
+# The seconds the connection to the SMTP server is kept open, without mails
+# to send.
+IDLE_SECONDS = 30
 
 def event2str(an_event):
 	'''Converts an event to a string'''
-	result = "'%s'" % an_event.get('SUMMARY')
-	start_dt_string = an_event.get('DTSTART').dt.strftime("%Y-%m-%d %H:%M")
+	result = "'%s'" % an_event.summary
+	start_dt_string = an_event.start.strftime("%Y-%m-%d %H:%M")
 	result += " starting %s " % start_dt_string
 	return result
 
+def entry2str(an_entry):
+	'''Converts an entry to a string'''
+	return "'%s' spent on %s " % (an_entry.comments, an_entry.spent_on)
+
 def get_error_message(err, style='simple'):
 	'''Converts an error to a message'''
 	if style == "html":
@@ -22,13 +29,117 @@ def get_error_message(err, style='simple'):
 	else:
 		result = "%s" % err['exp']
 	result += ": "
-	result += "Entry for event %s" % event2str(err['event'])
+	if err['event'] is None:
+		result += "Entry of removed event (uid=%s) " % err['uid']
+	else:
+		result += "Entry for event %s" % event2str(err['event'])
 	result += "referencing issue #%u" % int(err['issue_id'])
 	result += ", couldn't be %s" % err['destiny']
 	return result
 
+class Mailer(object):
+	'''Delivers mails in the background, through a single connection to the
+	SMTP server, which is logged into once and reused for every mail. The mails
+	are retried on transient failures, and delivered before close returns.'''
+	def __init__(self, settings):
+		self.settings = settings
+		self.queue = Queue.Queue()
+		self.smtp = None
+		self.thread = threading.Thread(target=self.work, name="mailer")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def put(self, msg):
+		'''Queues a mail to be delivered.'''
+		self.queue.put(msg)
+
+	def close(self):
+		'''Delivers the queued mails, and closes the connection.'''
+		log.debug("Delivering %u queued mail(s).", self.queue.qsize())
+		self.queue.put(None)
+		self.thread.join()
+
+	def work(self):
+		'''Delivers the queued mails, until closed.'''
+		while True:
+			try:
+				msg = self.queue.get(timeout=IDLE_SECONDS)
+			except Queue.Empty:
+				self.disconnect()
+				continue
+			if msg is None:
+				self.disconnect()
+				return
+			self.deliver(msg)
+
+	def connect(self):
+		'''Connects and logs into the SMTP server, unless already connected.'''
+		import smtplib
+		if self.smtp is None:
+			log.debug("Connecting to the SMTP server %s.",
+				self.settings['mail_smtp_host'])
+			smtp = smtplib.SMTP_SSL(self.settings['mail_smtp_host'])
+			try:
+				smtp.login(self.settings['mail_smtp_user'],
+					self.settings['mail_smtp_password'])
+			except:
+				smtp.close()
+				raise
+			self.smtp = smtp
+		return self.smtp
+
+	def disconnect(self):
+		'''Closes the connection to the SMTP server, if connected.'''
+		import smtplib
+		if self.smtp is not None:
+			try:
+				self.smtp.quit()
+			except (smtplib.SMTPException, socket.error):
+				self.smtp.close()
+			self.smtp = None
+
+	def deliver(self, msg):
+		'''Sends a mail, retrying it on transient failures: when the connection
+		is lost or the server answers with a 4xx code.'''
+		import smtplib
+		delay = RETRY_DELAY
+		for attempt in range(1, MAX_ATTEMPTS + 1):
+			started = time.time()
+			try:
+				refused = self.connect().sendmail(msg['From'], msg['To'],
+					msg.as_string())
+				if refused:
+					log.error("The mail to %s was refused: %s", msg['To'], refused)
+					metrics.count('mails', result='refused')
+				else:
+					metrics.count('mails', result='sent')
+				return
+			except (smtplib.SMTPServerDisconnected, socket.error) as err:
+				transient = True
+				# Connect again, on the next attempt.
+				self.disconnect()
+			except smtplib.SMTPResponseException as err:
+				transient = 400 <= err.smtp_code < 500
+			except smtplib.SMTPException as err:
+				transient = False
+			finally:
+				metrics.observe('mail_send', time.time() - started)
+			if not transient or attempt == MAX_ATTEMPTS:
+				log.error("Couldn't send the mail to %s: %s", msg['To'], err)
+				metrics.count('mails', result='failed')
+				return
+			log.warning("Couldn't send the mail to %s (attempt %u of %u), "
+				"retrying in %u seconds: %s", msg['To'], attempt, MAX_ATTEMPTS,
+				delay, err)
+			time.sleep(delay)
+			delay *= 2
+
 def send(summary_report, user, settings):
-	'''Send a summary to the user.'''
+	'''Send a summary to the user, through the mailer in settings['mailer']
+	which delivers it in the background.'''
+	# Import the email modules we'll need, when there is something to send.
+	from email.mime.text import MIMEText
+	from email.mime.multipart import MIMEMultipart
 	log.info("A summary should be sent to the user!")
 	simple_lines = []
 	html_lines = []
@@ -52,6 +163,16 @@ def send(summary_report, user, settings):
 			summary_report[destinator.DESTINY_DELETE])
 		html_lines.append("<p>Entries deleted: %u</p>" %
 			summary_report[destinator.DESTINY_DELETE])
+	if len(summary_report['orphans']) > 0:
+		simple_lines.append("Entries of events removed from the feed deleted: %u"
+			% len(summary_report['orphans']))
+		html_lines.append("<p>Entries of events removed from the feed deleted:"
+			" %u</p>" % len(summary_report['orphans']))
+		html_lines.append("<ul>")
+		for entry in summary_report['orphans']:
+			simple_lines.append("- %s" % entry2str(entry) )
+			html_lines.append("<li>%s</li>" % entry2str(entry) )
+		html_lines.append("</ul>")
 	if len(summary_report["recurring_events"]) > 0:
 		simple_lines.append("Recurring events found: %u." %
 			len(summary_report["recurring_events"]))
@@ -62,8 +183,9 @@ def send(summary_report, user, settings):
 			simple_lines.append("- %s" % event2str(recurring_event[0]) )
 			html_lines.append("<li>%s</li>" % event2str(recurring_event[0]) )
 		html_lines.append("</ul>")
-		simple_lines.append("Recurring events are not supported!")
-		html_lines.append("<p><b>Recurring events are not supported!</b></p>")
+		simple_lines.append("Occurrences of recurring events are synced until now.")
+		html_lines.append("<p>Occurrences of recurring events are synced until"
+			" now.</p>")
 	if len(summary_report['errors']) > 0:
 		simple_lines.append("%u errors occured: " % len(summary_report['errors']))
 		html_lines.append("%u errors occured: " % len(summary_report['errors']))
@@ -92,8 +214,4 @@ def send(summary_report, user, settings):
 	msg.attach( MIMEText(html_message.encode('utf-8'), 'html', 'utf-8') )
 	log.debug("=== Sending mail to %s ===\n\t%s\n=== END OF MESSAGE ===",
 		msg['To'], "\n\t".join(simple_message.split("\n")))
-	smtp = smtplib.SMTP_SSL(settings['mail_smtp_host'])
-	smtp.login(settings['mail_smtp_user'], settings['mail_smtp_password'])
-	response = smtp.sendmail(msg['From'], msg['To'], msg.as_string())
-	smtp.quit()
-	return len(response) == 0
\ No newline at end of file
+	settings['mailer'].put(msg)
\ No newline at end of file
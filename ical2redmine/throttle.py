@@ -0,0 +1,189 @@
+'''Throttles the requests to every Redmine host, adapting the rate to how the
+host responds, and failing fast while it's down.'''
+import random, threading, time
+from ical2redmine.logger import LOG as log
+from ical2redmine import metrics
+
+# The lowest rate (requests per second) the rate is slowed down to.
+MIN_RATE = 0.5
+# The factor the rate is slowed down by, at most once per DECREASE_SECONDS.
+DECREASE = 0.5
+DECREASE_SECONDS = 1.0
+# The requests per second the rate is sped up by, for every response in time.
+INCREASE = 0.2
+# A response is slow, when it took longer than this many times the fastest
+# response of the host, and longer than SLOW_SECONDS.
+SLOW_FACTOR = 4
+SLOW_SECONDS = 0.5
+# The failures in a row (errors or 5xx), after which the circuit is opened,
+# failing all requests for BREAKER_SECONDS before a single one is tried.
+BREAKER_FAILURES = 5
+BREAKER_SECONDS = 30
+# The delay before the first retry, doubling for every retry after it, up to
+# BACKOFF_MAX_SECONDS. A random part of the delay is waited (full jitter).
+BACKOFF_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30
+
+MAX_RATE = 0
+MAX_RETRIES = 3
+THROTTLES = {}
+THROTTLES_LOCK = threading.Lock()
+
+class CircuitOpen(Exception):
+	'''Raised instead of making a request, while the circuit of the host is
+	open.'''
+
+def setup(max_rate=0, max_retries=3):
+	'''Sets the highest rate (requests per second, 0 for no limit) of every
+	host, and how many times a failed request is retried.'''
+	global MAX_RATE, MAX_RETRIES
+	MAX_RATE = max_rate
+	MAX_RETRIES = max_retries
+	with THROTTLES_LOCK:
+		THROTTLES.clear()
+
+def get(host):
+	'''Gets the throttle of a host, shared by all requests to it.'''
+	with THROTTLES_LOCK:
+		if host not in THROTTLES:
+			THROTTLES[host] = Throttle(host, MAX_RATE)
+		return THROTTLES[host]
+
+def backoff(attempt):
+	'''The seconds to wait before retrying, after the attempt failed.'''
+	return random.uniform(0, min(BACKOFF_MAX_SECONDS,
+		BACKOFF_SECONDS * 2 ** (attempt - 1)))
+
+class Throttle(object):
+	'''A token bucket, holding up to a second of requests, refilled at a rate
+	adapting to the host: The rate is halved when the host asks to slow down
+	(429 or 503) or responds slowly or fails, and sped up again a little for
+	every response in time. Without a highest rate, requests aren't limited
+	until the host first asks to slow down, and again once the rate has
+	recovered. The throttle is also a circuit breaker, which opens after
+	failures in a row, and is closed again by a single request trying the host
+	after a while. The throttle can be shared by threads.'''
+	def __init__(self, host, max_rate=0):
+		self.host = host
+		self.max_rate = max_rate
+		self.lock = threading.Lock()
+		# The rate, None while unlimited.
+		self.rate = max_rate or None
+		# The rate to recover to, before requests are unlimited again.
+		self.ceiling = max_rate or None
+		self.tokens = float(max_rate)
+		self.refilled = time.time()
+		self.decreased = 0
+		self.fastest = None
+		# The requests made this second and the last, telling the rate when
+		# requests start to be limited.
+		self.window = (int(self.refilled), 0, 0)
+		self.failures = 0
+		self.opened = None
+		self.trying = False
+
+	def acquire(self):
+		'''Waits for a request to be allowed, raising CircuitOpen if the host
+		is failing.'''
+		with self.lock:
+			now = time.time()
+			self.check_circuit(now)
+			second, count, last_count = self.window
+			if int(now) != second:
+				last_count = count if int(now) == second + 1 else 0
+				second, count = int(now), 0
+			self.window = (second, count + 1, last_count)
+			if self.rate is None:
+				return
+			self.tokens = min(max(self.rate, 1.0),
+				self.tokens + (now - self.refilled) * self.rate)
+			self.refilled = now
+			# Tokens are taken in advance, so waiting requests keep their turn.
+			self.tokens -= 1
+			wait = -self.tokens / self.rate if self.tokens < 0 else 0
+		if wait:
+			metrics.count('redmine_throttle', event='delayed')
+			time.sleep(wait)
+
+	def check_circuit(self, now):
+		'''Fails fast while the circuit is open. Once it has been open for a
+		while, a single request is let through to try the host.'''
+		if self.opened is None:
+			return
+		if self.trying or now < self.opened + BREAKER_SECONDS:
+			metrics.count('redmine_throttle', event='rejected')
+			raise CircuitOpen("Redmine at %s is failing, not trying it again for "
+				"%u seconds." % (self.host, max(self.opened + BREAKER_SECONDS - now,
+				0)))
+		log.info("Trying Redmine at %s again.", self.host)
+		self.trying = True
+
+	def succeeded(self, seconds):
+		'''A response in the seconds given, speeding the rate up unless slow.'''
+		with self.lock:
+			self.close_circuit()
+			self.failures = 0
+			if self.fastest is None or seconds < self.fastest:
+				self.fastest = seconds
+			if seconds > SLOW_SECONDS and seconds > SLOW_FACTOR * self.fastest:
+				self.decrease("responded in %.1f seconds" % seconds)
+			elif self.rate is not None:
+				self.rate += INCREASE
+				if self.ceiling and self.rate >= self.ceiling:
+					self.rate = self.max_rate or None
+					self.ceiling = self.max_rate or None
+					if self.rate is None:
+						log.info("Redmine at %s has recovered, no longer limiting the "
+							"requests.", self.host)
+
+	def throttled(self, status):
+		'''The host asked to slow down, it's up but busy.'''
+		with self.lock:
+			self.close_circuit()
+			self.decrease("responded %u" % status)
+
+	def failed(self, reason):
+		'''A request failed (or the host is down), opening the circuit after
+		failures in a row.'''
+		with self.lock:
+			self.failures += 1
+			self.decrease(reason)
+			if self.trying or self.failures >= BREAKER_FAILURES:
+				if self.opened is None or self.trying:
+					log.error("Redmine at %s failed %u time(s) in a row (%s), failing "
+						"requests for %u seconds.", self.host, self.failures, reason,
+						BREAKER_SECONDS)
+					metrics.count('redmine_throttle', event='opened')
+				self.opened = time.time()
+				self.trying = False
+
+	def wait(self, seconds):
+		'''Holds back all requests for the seconds the host asked to wait,
+		including the retries.'''
+		with self.lock:
+			if self.rate is not None:
+				self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+	def close_circuit(self):
+		'''The host responded, closing the circuit if open.'''
+		if self.opened is not None:
+			log.info("Redmine at %s responds again.", self.host)
+		self.opened = None
+		self.trying = False
+
+	def decrease(self, reason):
+		'''Slows the rate down, unless just done.'''
+		now = time.time()
+		if now < self.decreased + DECREASE_SECONDS:
+			return
+		self.decreased = now
+		if self.rate is None:
+			# Start from the requests made in the last second.
+			self.rate = self.ceiling = float(max(self.window[2], self.window[1],
+				MIN_RATE))
+			self.tokens = 0
+			self.refilled = now
+		self.rate = max(self.rate * DECREASE, MIN_RATE)
+		metrics.count('redmine_throttle', event='slowed')
+		log.warning("Redmine at %s %s, slowing down to %.1f requests per "
+			"second.", self.host, reason, self.rate)
@@ -0,0 +1,141 @@
+'''A shared HTTP transport, pooling keep-alive connections for all requests.'''
+import threading, time, urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from pyactiveresource import connection
+from ical2redmine.logger import LOG as log
+from ical2redmine import metrics, throttle
+
+# Responses telling the request wasn't handled, as the server is busy, so it
+# can be retried whatever its method.
+THROTTLED_STATUSES = [ 429, 503 ]
+# Responses from a gateway, for which it's unknown if the request was handled.
+GATEWAY_STATUSES = [ 502, 504 ]
+# The requests, which can be retried if it's unknown whether they were handled.
+IDEMPOTENT_METHODS = [ 'GET', 'HEAD', 'PUT' ]
+
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+def setup(pool_size=10):
+	'''Sets up the shared session, keeping up to pool_size connections open
+	to every host. When they are all in use, requests waits for one to free.'''
+	global SESSION
+	session = requests.Session()
+	adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+		pool_block=True)
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	session.headers['Accept-Encoding'] = 'gzip'
+	session.hooks['response'].append(count_response)
+	SESSION = session
+	return session
+
+def count_response(response, *args, **kwargs):
+	'''Counts the requests made, by method.'''
+	metrics.count('http_requests', method=response.request.method)
+
+def get_session():
+	'''Gets the shared session, setting it up with defaults if it's not.'''
+	with SESSION_LOCK:
+		if SESSION is None:
+			setup()
+		return SESSION
+
+def stats():
+	'''Counts the requests made and the connections opened to make them.'''
+	result = { 'requests': 0, 'connections': 0 }
+	if SESSION is None:
+		return result
+	for adapter in set(SESSION.adapters.values()):
+		pools = adapter.poolmanager.pools
+		for key in pools.keys():
+			pool = pools.get(key)
+			if pool is not None:
+				result['requests'] += pool.num_requests
+				result['connections'] += pool.num_connections
+	result['reused'] = max(result['requests'] - result['connections'], 0)
+	return result
+
+class PooledResponse(object):
+	'''Wraps a requests response, as the httplib response pyactiveresource
+	expects from urllib2.'''
+	def __init__(self, response):
+		self.code = response.status_code
+		self.msg = response.reason
+		self.url = response.url
+		self.headers = dict(response.headers)
+		self.body = response.content
+		metrics.count('http_response_bytes', len(self.body))
+
+	def read(self):
+		'''Reads the entire body.'''
+		return self.body
+
+	def close(self):
+		'''The body is already read, and the connection back in the pool.'''
+		pass
+
+def retry_after(response):
+	'''The seconds a response asks to wait before retrying, None if it doesn't
+	say (or gives a date).'''
+	try:
+		return max(int(response.headers.get('Retry-After')), 0)
+	except (TypeError, ValueError):
+		return None
+
+class PooledConnection(connection.Connection):
+	'''A pyactiveresource connection, sending its requests through the shared
+	session rather than opening a new connection using urllib2. The requests
+	are throttled per host, and retried (after backing off) when the host is
+	busy, or failed in a way that's safe to retry.'''
+	def _urlopen(self, request):
+		url = request.get_full_url()
+		method = request.get_method()
+		host_throttle = throttle.get(urlparse.urlsplit(url).netloc)
+		attempt = 0
+		while True:
+			attempt += 1
+			try:
+				host_throttle.acquire()
+			except throttle.CircuitOpen as err:
+				raise connection.Error(err, url)
+			started = time.time()
+			try:
+				response = get_session().request(method, url,
+					data=request.get_data(), headers=dict(request.header_items()),
+					timeout=self.timeout, allow_redirects=False)
+			except requests.RequestException as err:
+				log.debug("Request to %s failed: %s", url, err)
+				host_throttle.failed(type(err).__name__)
+				if method in IDEMPOTENT_METHODS and attempt <= throttle.MAX_RETRIES:
+					self.retry(method, url, attempt, err)
+					continue
+				raise connection.Error(err, url)
+			status = response.status_code
+			if status in THROTTLED_STATUSES or status in GATEWAY_STATUSES:
+				if status == 429:
+					host_throttle.throttled(status)
+				else:
+					host_throttle.failed("responded %u" % status)
+				delay = retry_after(response)
+				if delay:
+					host_throttle.wait(delay)
+				if attempt <= throttle.MAX_RETRIES and (status in THROTTLED_STATUSES
+					or method in IDEMPOTENT_METHODS):
+					response.close()
+					self.retry(method, url, attempt, status)
+					continue
+			elif status >= 500:
+				host_throttle.failed("responded %u" % status)
+			else:
+				host_throttle.succeeded(time.time() - started)
+			return PooledResponse(response)
+
+	def retry(self, method, url, attempt, reason):
+		'''Backs off before retrying a request.'''
+		delay = throttle.backoff(attempt)
+		log.warning("Retrying %s %s in %.1f seconds (%u of %u): %s", method, url,
+			delay, attempt, throttle.MAX_RETRIES, reason)
+		metrics.count('redmine_throttle', event='retried')
+		time.sleep(delay)
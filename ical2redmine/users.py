@@ -1,70 +1,191 @@
 '''This module fetches and processes users from Redmine'''
-import sys
+import sys, calendar
 from ical2redmine.logger import LOG as log
-from ical2redmine import events, entries, redmine, destinator, summary
+from ical2redmine import events, entries, redmine, destinator, summary, pool
+from ical2redmine import cache, state, metrics, feeds
 
 def fetch(settings):
-	'''Fetches users from Redmine'''
+	'''Fetches the active users with an iCal URL from Redmine, page by page.
+	This is a generator, so users can be processed while fetching the rest.'''
 	log.debug("Fetching users from %s." % settings["redmine_url"])
 	from ical2redmine.redmine import Users
-	result = []
-	for user in Users.find():
-		ical_url = user.get_custom_field_value(settings['custom_user_field_id'])
-		if ical_url:
-			result.append(user)
-	return result
+	custom_field_id = settings['custom_user_field_id']
+	query = {
+		'status': 1, # Active
+		'limit': redmine.PAGE_SIZE,
+		'cf_%u' % custom_field_id: '*'
+	}
+	offset = 0
+	while True:
+		found_users = Users.find( offset=offset, **query )
+		offset += len(found_users)
+		for user in found_users:
+			# Check the URL, in case the Redmine didn't know the filter.
+			ical_url = user.get_custom_field_value(custom_field_id)
+			if ical_url:
+				yield user
+		# A page that isn't full is the last one.
+		if len(found_users) < redmine.PAGE_SIZE:
+			break
 
 def process(all_users, settings):
-	'''Processes users from Redmine'''
-	# Process all the users.
-	for user in all_users:
-		log.info("Processing Redmine user with login '%s'" % user.login)
-		redmine.impersonate_user(user)
-		ical_url = user.get_custom_field_value(settings['custom_user_field_id'])
-		assert ical_url, "The iCal customfield was not sat for this particular user."
-		# Fetch the events.
-		try:
-			users_events = events.fetch(ical_url)
-		except Exception as err:
-			log.error( "Couldn't fetch iCal events: %s", err )
-			continue
-		log.info( "Found %u events in the iCal feed." % len(users_events) )
-		# Fetch all Redmine time entries for this particular user.
-		users_entries = entries.fetch(user, settings)
-		log.info( "Found %u entries in the Redmine." % len(users_entries) )
-		# Gather ical uids from the Redmine time entries.
-		existing_user_entries = {}
-		for entry in users_entries:
-			uid = entry.get_custom_field_value(settings["custom_time_entry_field_id"])
-			if uid in existing_user_entries.keys():
-				other_id = existing_user_entries[uid].id
-				log.error('Found two time entries (id=%s and id=%s)' +
-					' referencing the same iCal uid=%s!', entry.id, other_id, uid )
-				continue # Skip the insertion of this entry.
-			existing_user_entries[uid] = entry
-		if len(existing_user_entries.keys()) != len(users_entries):
-			log.error('Found duplicate uids in Redmine, please fix this manually!')
-			sys.exit(-1)
-		# Process the events.
-		summary_report = events.process(users_events, existing_user_entries, settings)
-		# TODO: Find out if there are entries that needs to be removed,
-		# because they were removed as events.
+	'''Processes users from Redmine, using a pool of settings['workers'].
+	Returns the number of users processed, not counting users of other shards.
+	Every user processed is checkpointed in the journal (if any), and users
+	checkpointed by an interrupted run are skipped when it's resumed. The feeds
+	are shared between the users of the run.'''
+	journal = settings.get('journal')
+	registry = feeds.FeedRegistry()
+	settings = dict(settings, feed_registry=registry)
+	def process_checkpointed(user):
+		'''Processes a user, unless synced before the run was interrupted.'''
+		if journal and journal.synced(user):
+			log.info("Skipping the user '%s', synced before the run was "
+				"interrupted.", user.login)
+			return None
+		result = process_user(user, settings)
+		if journal and result is not None:
+			journal.checkpoint(user)
+		return result
+	results = pool.run(process_checkpointed, all_users, settings['workers'])
+	registry.report()
+	return len([result for result in results if result is not None])
+
+def process_user(user, settings):
+	'''Processes a single user from Redmine, profiling it if a profiler is
+	given in settings['profiler']. Returns what sync_user returns, or None if
+	the user belongs to another shard than settings['shard'].'''
+	shard = settings.get('shard')
+	if shard and not shard.claim(user):
+		log.debug("Skipping the user '%s' of another shard.", user.login)
+		metrics.count('users', result='other shard')
+		return None
+	try:
+		profiler = settings.get('profiler')
+		if profiler:
+			return profiler.call(user.login, sync_user, user, settings)
+		return sync_user(user, settings)
+	finally:
+		if shard:
+			shard.release(user)
+
+def checkpoint(settings, stage):
+	'''Marks the boundary of a stage, for the profiler if any.'''
+	profiler = settings.get('profiler')
+	if profiler:
+		profiler.checkpoint(stage)
+
+def sync_user(user, settings):
+	'''Syncs a single user from Redmine.
+	Returns True if the users feed had changed (or there's no feed cache to
+	tell) and was synced, False otherwise.'''
+	log.info("Processing Redmine user with login '%s'" % user.login)
+	metrics.set_user(user.login)
+	session = redmine.impersonate_user(user)
+	ical_url = user.get_custom_field_value(settings['custom_user_field_id'])
+	assert ical_url, "The iCal customfield was not sat for this particular user."
+	# The routes of the user and calendar, used from here on.
+	settings = dict(settings, matcher=settings['router'].matcher(user.login,
+		ical_url))
+	journal = settings.get('journal')
+	in_flight = journal.reconcile(user) if journal else []
+	if in_flight:
+		# Writes that may or may not have been done, are seen in Redmine.
+		log.warning("Reconciling %u write(s) in flight when the last run was "
+			"interrupted, with all the entries in Redmine.", len(in_flight))
+	feed_cache = settings.get('feed_cache')
+	cached = None
+	if feed_cache:
+		cached = feed_cache.get(user, ical_url)
+		if in_flight or not cache.is_valid(cached, settings):
+			cached = {}
+	# Fetch the events, and the UIDs of all events in the feed.
+	feed_uids = set()
+	registry = settings.get('feed_registry')
+	try:
+		if registry:
+			users_events = registry.fetch(ical_url, settings, cached, feed_uids)
+		else:
+			users_events = events.fetch(ical_url, settings, cached, feed_uids)
+	except Exception as err:
+		log.error( "Couldn't fetch iCal events: %s", err )
+		metrics.count('users', result='failed')
+		return False
+	if users_events is None:
+		log.info("The iCal feed hasn't changed since the last sync, skipping.")
+		metrics.count('users', result='unchanged')
+		return False
+	log.info( "Found %u events in the iCal feed, matching the pattern."
+		% len(users_events) )
+	checkpoint(settings, 'feed fetched')
+	# Fetch all Redmine time entries for this particular user.
+	state_store = settings.get('state_store')
+	if state_store:
+		users_entries = state.refresh(state_store, session, settings,
+			bool(in_flight))
+	else:
+		users_entries = entries.fetch(session, settings)
+	log.info( "Found %u entries in the Redmine." % len(users_entries) )
+	checkpoint(settings, 'entries fetched')
+	# Gather ical uids from the Redmine time entries.
+	existing_user_entries = {}
+	for entry in users_entries:
+		uid = entry.get_custom_field_value(settings["custom_time_entry_field_id"])
+		if uid in existing_user_entries.keys():
+			other_id = existing_user_entries[uid].id
+			log.error('Found two time entries (id=%s and id=%s)' +
+				' referencing the same iCal uid=%s!', entry.id, other_id, uid )
+			continue # Skip the insertion of this entry.
+		existing_user_entries[uid] = entry
+	if len(existing_user_entries.keys()) != len(users_entries):
+		log.error('Found duplicate uids in Redmine, please fix this manually!')
+		sys.exit(-1)
+	plan_writer = settings.get('plan_writer')
+	if plan_writer:
+		# Only plan the writes, to be applied later.
+		summary_report, writes = events.plan(session, users_events,
+			existing_user_entries, settings, feed_uids)
+		plan_writer.add(user, writes, existing_user_entries, settings)
 		log.info("Skipped: %u", summary_report[destinator.DESTINY_SKIP])
-		log.info("Entries created: %u" % summary_report[destinator.DESTINY_CREATE])
-		log.info("Entries updated: %u" % summary_report[destinator.DESTINY_UPDATE])
-		log.info("Entries deleted: %u" % summary_report[destinator.DESTINY_DELETE])
-		log.info("Recurring events: %u" % len(summary_report["recurring_events"]))
-		log.info("Errors: %u", len(summary_report['errors']))
-		for err in summary_report['errors']:
-			log.error("Error '%s': when an entry for issue #%u was attempted %s." % (
-				err['exp'],
-				int(err['issue_id']),
-				err['destiny']
-			))
-		should_send_summary = summary_report[destinator.DESTINY_CREATE] > 0 or \
-			summary_report[destinator.DESTINY_UPDATE] > 0 or \
-			summary_report[destinator.DESTINY_DELETE] > 0 or \
-			len(summary_report['errors']) > 0
-			# TODO: Consider that this might end up spamming the user.
-		if should_send_summary:
-			summary.send(summary_report, user, settings)
+		log.info("Planned writes: %u", len(writes))
+		metrics.count('users', result='planned')
+		return True
+	# Process the events.
+	summary_report = events.process(session, users_events,
+		existing_user_entries, settings, feed_uids)
+	checkpoint(settings, 'events processed')
+	log.info("Skipped: %u", summary_report[destinator.DESTINY_SKIP])
+	log.info("Entries created: %u" % summary_report[destinator.DESTINY_CREATE])
+	log.info("Entries updated: %u" % summary_report[destinator.DESTINY_UPDATE])
+	log.info("Entries deleted: %u" % summary_report[destinator.DESTINY_DELETE])
+	log.info("Entries of removed events deleted: %u"
+		% len(summary_report['orphans']))
+	log.info("Recurring events: %u" % len(summary_report["recurring_events"]))
+	log.info("Errors: %u", len(summary_report['errors']))
+	metrics.count('users', result='synced')
+	for destiny in destinator.DESTINIES:
+		metrics.count('entries', summary_report[destiny], destiny=destiny)
+	metrics.count('entries', len(summary_report['orphans']), destiny='orphaned')
+	metrics.count('errors', len(summary_report['errors']))
+	for err in summary_report['errors']:
+		log.error("Error '%s': when an entry for issue #%u was attempted %s." % (
+			err['exp'],
+			int(err['issue_id']),
+			err['destiny']
+		))
+	should_send_summary = summary_report[destinator.DESTINY_CREATE] > 0 or \
+		summary_report[destinator.DESTINY_UPDATE] > 0 or \
+		summary_report[destinator.DESTINY_DELETE] > 0 or \
+		len(summary_report['orphans']) > 0 or \
+		len(summary_report['errors']) > 0
+		# TODO: Consider that this might end up spamming the user.
+	if should_send_summary and settings['mail_send_summary']:
+		summary.send(summary_report, user, settings)
+	if feed_cache and len(summary_report['errors']) == 0:
+		due = summary_report['due']
+		cached.update({
+			'fingerprint': cache.fingerprint(settings),
+			'due': calendar.timegm(due.utctimetuple()) if due else None
+		})
+		feed_cache.put(user, ical_url, cached)
+	return True